@@ -6,19 +6,19 @@
 #
 #
 
-from abe import BNCurve, lagrange_basis
+from abe import BNCurve, FastBNCurve, use_fast_backend, lagrange_basis
 from sage.rings.all import *;
 from sage.rings.finite_rings.finite_field_base import FiniteField as FqInst
 from sage.rings.finite_rings.finite_field_constructor import FiniteFieldFactory
 from sage.schemes.all import *;
 from sage.schemes.elliptic_curves.ell_point import EllipticCurvePoint
+from sage.misc.misc_c import balanced_sum
 from hashlib import sha256
+import secrets
 
 def random_non_zero(ff : FiniteFieldFactory) -> FqInst:
-    while True:
-        s = ff.random_element()
-        if s != 0:
-            return s
+    n = int(ff.order())
+    return ff(secrets.randbelow(n-1) + 1)
 
 
 # def Li(i : int, crs : list[EllipticCurvePoint], at_tau : bool):
@@ -50,12 +50,16 @@ class GKPWRegistrar:
 
         Fp = curve.scalar_field()
         tau = random_non_zero(Fp)
-        tau_powers =  [
-            tau ** i for i in range(1, max_users+2)
-        ]
 
-        crs0 = [ x * curve.g0() for x in tau_powers ]
-        crs1 = [ x * curve.g1() for x in tau_powers ]
+        # tau^i is kept as a running product, and the tau^i * g0 and
+        # tau^i * g1 points are normalized to affine in one batch.
+        tau_powers = []
+        power = Fp(1)
+        for _ in range(max_users+1):
+            power = power * tau
+            tau_powers.append(power)
+
+        (crs0, crs1) = curve.mul_g0g1_batch(tau_powers)
 
         self._crs = { 0 : crs0, 1: crs1 }
 
@@ -105,8 +109,8 @@ class GKPWUser:
         """
         This method corresponds to keygen method in the scheme
         """
-        self._sk = random_non_zero(self.curve())
-        self._pk = self._sk*self.curve().g0()
+        self._sk = random_non_zero(self.curve().scalar_field())
+        self._pk = self.curve().mul_g0(self._sk)
         return self._pk
 
     def hintGen(self):
@@ -117,15 +121,27 @@ class BLSSign:
         self.curve = curve
         self.secret = None
         self.public = None
+        # Miller loop lines of the public key, see _public_precomp
+        self._pk_precomp = None
+        # Curve methods used on every sign/verify
+        self._hash2g0 = curve.hash2g0
+        self._hash2g0_affine = curve.hash2g0_affine
+
+    def _public_precomp(self):
+        """
+        The public key is the fixed G1 argument of every verification, so
+        its Miller loop lines are computed once per key
+        """
+        if self._pk_precomp is None or self._pk_precomp.point() is not self.public:
+            self._pk_precomp = self.curve.precompute_pairing_coeffs(self.public)
+        return self._pk_precomp
 
     @staticmethod
     def from_pk(curve: BNCurve, vk: EllipticCurvePoint | list[EllipticCurvePoint]):
         this = BLSSign(curve=curve)
 
         if isinstance(vk, (list,)):
-            this.public = 0*curve.g1()
-            for vki in vk:
-                this.public += vki
+            this.public = balanced_sum(vk, curve.identity())
         else:
             this.public = vk
 
@@ -137,48 +153,103 @@ class BLSSign:
         Group G2
         """
         self.secret = self.curve.scalar_field().random_element()
-        self.public = self.secret * self.curve.g1()
+        self.public = self.curve.scalar_mul_fixed_base(self.secret)
         return self.public
 
     def sign(self, message : bytes | str) -> EllipticCurvePoint:
         """
         Sign a message. The signature is in group G1.
         """
-        if self.secret == None:
+        if self.secret is None:
             raise ValueError("Key does not contain a secret")
-        hashed_point = self.curve.hash2g0(message)
-        return self.secret*hashed_point
+        hashed_point = self._hash2g0(message)
+        return self.curve.glv_mul(hashed_point, self.secret)
 
     def verify(self, message: bytes | str, sig : EllipticCurvePoint) -> bool:
-        if self.verify == None:
+        if self.public is None:
             raise ValueError("Key does not contain a public key")
 
-        hashed_point = self.curve.hash2g0(message)
-        right_pairing = self.curve.pair(sig, self.curve.g1())
-        left_pairing = self.curve.pair(hashed_point, self.public)
-        return left_pairing == right_pairing
+        # e(H(m), pk) == e(sig, g1) iff e(H(m), pk) * e(sig, -g1) == 1.
+        # Both G1 arguments are fixed, so only their precomputed lines
+        # are evaluated, in one shared Miller loop.
+        curve = self.curve
+        hashed_point = self._hash2g0_affine(message)
+        f = curve.multi_miller_loop([
+            (hashed_point, self._public_precomp()),
+            (sig, curve.neg_g1_precomp())
+        ])
+        return curve.gt_is_one(curve.final_exp(f))
 
     @staticmethod
     def aggregate_sigs(curve : BNCurve,
                   message: bytes|str,
                   signatures : list[EllipticCurvePoint],
-                  verification_keys: list[EllipticCurvePoint]) -> EllipticCurvePoint:
+                  verification_keys: list[EllipticCurvePoint],
+                  verify_each : bool = False) -> EllipticCurvePoint:
         """
         Trivial signature aggregation that's insecure to EU-CMA (**DONT
-        USE IN REAL WORLD**). The Signatures are first verified and then
-        aggregated.
+        USE IN REAL WORLD**). The signatures and the verification keys
+        are first summed up and the aggregate is checked with a single
+        pair of pairings, e(sum sig_i, g1) == e(H(m), sum vk_i). With
+        `verify_each` every signature is verified individually instead.
         """
 
-        aggr_sig = 0*curve.g0()
+        if verify_each:
+            aggr_sig = 0*curve.g0()
+            for (sig,vk) in zip(signatures, verification_keys):
+                pubkey = BLSSign.from_pk(curve, vk)
+                if pubkey.verify(message, sig):
+                    aggr_sig = aggr_sig + sig
+                else:
+                    raise ValueError("Signature verification failed. Signature cannot be aggregated")
+            return aggr_sig
+
+        aggr_sig = balanced_sum(list(signatures), curve.identity())
+        aggr_pk = balanced_sum(list(verification_keys), curve.identity())
+
+        lhs = curve.pair_points(aggr_sig, curve.g1())
+        rhs = curve.pair_points(curve.hash2g0(message), aggr_pk)
+
+        if lhs != rhs:
+            raise ValueError("Signature verification failed. Signature cannot be aggregated")
 
-        for (sig,vk) in zip(signatures, verification_keys):
-            pubkey = BLSSign.from_pk(curve, vk)
-            if pubkey.verify(message, sig):
-                aggr_sig = aggr_sig + sig
-            else:
-                raise ValueError("Signature verification failed. Signature cannot be aggregated")
         return aggr_sig
 
+    @staticmethod
+    def verify_batch(curve : BNCurve,
+                     messages: list[bytes|str],
+                     signatures : list[EllipticCurvePoint],
+                     verification_keys: list[EllipticCurvePoint]) -> bool:
+        """
+        Check e(sum sig_i, g1) == prod e(H(m_i), vk_i). The pairings are
+        independent, so pair_many computes them in parallel when there
+        are enough of them.
+        """
+        aggr_sig = balanced_sum(list(signatures), curve.identity())
+        hashed = curve.hash2g0_batch(messages)
+        pairs = [(aggr_sig, curve.g1())] + list(zip(hashed, verification_keys))
+        values = curve.pair_many(pairs)
+
+        rhs = curve.extension_field()(1)
+        for v in values[1:]:
+            rhs = rhs * v
+        return values[0] == rhs
+
+    @staticmethod
+    def aggregate_sigs_distinct_msgs(curve : BNCurve,
+                  messages: list[bytes|str],
+                  signatures : list[EllipticCurvePoint],
+                  verification_keys: list[EllipticCurvePoint]) -> EllipticCurvePoint:
+        """
+        Aggregate signatures on different messages. The aggregate is
+        checked with verify_batch, which still needs one pairing per
+        signer on the right hand side.
+        """
+        if not BLSSign.verify_batch(curve, messages, signatures, verification_keys):
+            raise ValueError("Signature verification failed. Signature cannot be aggregated")
+
+        return balanced_sum(list(signatures), curve.identity())
+
     @staticmethod
     def single_signature_test(curve : BNCurve):
         bls_signer = BLSSign(curve);
@@ -207,6 +278,13 @@ class BLSSign:
 
         assert aggr_pk.verify(msg, aggr_sig), "Signature verification failed"
 
+        msgs = [msg + bytes([i]) for i in range(count)]
+        signers = [BLSSign(curve) for _ in range(count)]
+        vks = [signer.keygen() for signer in signers]
+        sigs = [signer.sign(m) for (signer, m) in zip(signers, msgs)]
+        assert BLSSign.verify_batch(curve, msgs, sigs, vks), "Batch verification failed"
+        assert not BLSSign.verify_batch(curve, msgs[::-1], sigs, vks), "Batch verification passed"
+
 
 class PKEFromSignature:
     """
@@ -215,36 +293,85 @@ class PKEFromSignature:
     def __init__(self, curve : BNCurve) -> None:
         self.curve = curve
         self.bls = BLSSign(curve=curve)
+        # Curve methods and constants used on every encrypt/decrypt
+        self._order = int(curve.order())
+        self._hash2g0 = curve.hash2g0
+        self._glv_mul = curve.glv_mul
+        self._pair = curve.pair_points
 
     def keygen(self):
         self.pk = self.bls.keygen()
         return self.pk
 
     def encrypt(self, public_key : EllipticCurvePoint, message: FqInst, tag : bytes):
-        r = self.curve.scalar_field().random_element()
-        h = self.curve.hash2g0(tag)
-        pair = self.curve.pair(r*h, public_key)
-        c1 = r*self.curve.g1()
+        r = secrets.randbelow(self._order - 1) + 1
+        h = self._hash2g0(tag)
+        pair = self._pair(self._glv_mul(h, r), public_key)
+        c1 = self.curve.scalar_mul_fixed_base(r)
         c2 = message*pair
         return (c1, c2)
 
+    def encrypt_batch(self, public_key : EllipticCurvePoint, messages, tags):
+        """
+        Encrypt messages[i] under tags[i] for every i. The tags are hashed
+        together, and since e(r*h, pk) = e(h, pk)^r, every distinct tag
+        costs one pairing (through pair_many, in parallel for many tags),
+        and every message one GT exponentiation and one fixed-base
+        multiplication.
+        """
+        curve = self.curve
+        distinct = list(dict.fromkeys(tags))
+        hashed = curve.hash2g0_batch(distinct)
+        bases = dict(zip(distinct, curve.pair_many([(h, public_key) for h in hashed])))
+        cts = []
+        for (message, tag) in zip(messages, tags):
+            r = secrets.randbelow(self._order - 1) + 1
+            c1 = curve.scalar_mul_fixed_base(r)
+            c2 = message*curve.gt_pow_wnaf(bases[tag], r)
+            cts.append((c1, c2))
+        return cts
+
     def decrypt(self, ct, tag : bytes):
-        h = self.curve.hash2g0(tag)
-        factor = self.curve.pair(h, ct[0])**self.bls.secret
-        m = ct[1]/ factor
+        h = self._hash2g0(tag)
+        factor = self.curve.gt_pow_wnaf(self._pair(h, ct[0]), self.bls.secret)
+        m = ct[1] / factor
         return m
 
+    def decrypt_batch(self, cts, tags):
+        """
+        Decrypt the ciphertext cts[i] under tags[i] for every i. The tags
+        are hashed together, and since e(h, c1)^sk = e(sk*h, c1), every
+        distinct tag costs one scalar multiplication instead of one GT
+        exponentiation per ciphertext.
+        """
+        keyed = dict()
+        for (tag, h) in zip(tags, self.curve.hash2g0_batch(tags)):
+            if tag not in keyed:
+                keyed[tag] = self._glv_mul(h, self.bls.secret)
+        return [
+            ct[1] / self._pair(keyed[tag], ct[0])
+            for (ct, tag) in zip(cts, tags)
+        ]
+
     @staticmethod
     def run_sample_test(bn_curve : BNCurve):
         tag = b"Admin"
         cryptor = PKEFromSignature(bn_curve)
         pk = cryptor.keygen()
         r = cryptor.curve.scalar_field().random_element()
-        message = cryptor.curve.gt()**r
+        message = cryptor.curve.gt_pow(cryptor.curve.gt(), r)
         ct = cryptor.encrypt(pk, message, tag)
         m = cryptor.decrypt(ct, tag=tag)
         assert m == message, "Failed to decrypt correctly"
 
+        messages = [cryptor.curve.gt_pow(cryptor.curve.gt(), k) for k in range(1, 4)]
+        tags = [tag, b"Other", tag]
+        cts = [cryptor.encrypt(pk, m, t) for (m, t) in zip(messages, tags)]
+        assert cryptor.decrypt_batch(cts, tags) == messages, "Failed to decrypt the batch"
+        cts = cryptor.encrypt_batch(pk, messages, tags)
+        assert cryptor.decrypt_batch(cts, tags) == messages, "Failed to encrypt the batch"
+        assert [cryptor.decrypt(ct, t) for (ct, t) in zip(cts, tags)] == messages
+
 
 if __name__ == '__main__':
     # Generated using curve_32()
@@ -253,7 +380,10 @@ if __name__ == '__main__':
     CURVE_B=29
     CURVE_Y=1270807500
 
-    BN_CURVE_32 = BNCurve(BASE_FIELD_PRIME, CURVE_ORDER, CURVE_B, CURVE_Y)
+    if use_fast_backend():
+        BN_CURVE_32 = FastBNCurve()
+    else:
+        BN_CURVE_32 = BNCurve(BASE_FIELD_PRIME, CURVE_ORDER, CURVE_B, CURVE_Y)
 
 
     def main():
@@ -1,5 +1,6 @@
-from .bn_curve_gen import bn_curve_gen, curve_32, BNCurve
-from .lagrange_interpolate import lagrange_basis
+from .bn_curve_gen import bn_curve_gen, curve_32, BNCurve, build_comb, comb_mul, wnaf, wnaf_mul, PrecomputedG2
+from .bn_curve_fast import FastBNCurve, use_fast_backend
+from .lagrange_interpolate import lagrange_basis, lagrange_weights, lagrange_eval_all
 from .monotone_formula import *
 from .poly_commit import *
 from .secret_sharing import *
\ No newline at end of file
@@ -0,0 +1,314 @@
+#
+# A BN254 backend built on py_ecc's optimized_bn128 module. It exposes the
+# same interface as BNCurve so that the schemes built on top of BNCurve
+# can run on a specialized pairing implementation.
+#
+
+import os
+import secrets
+import functools
+from hashlib import sha256
+
+try:
+    from py_ecc import optimized_bn128 as bn
+except ImportError:
+    bn = None
+
+def use_fast_backend() -> bool:
+    """
+    The fast backend is selected by setting SAGEABE_BACKEND=fast
+    """
+    return os.environ.get("SAGEABE_BACKEND") == "fast"
+
+
+class FastPoint:
+    """
+    Wrapper around py_ecc's projective point tuples providing the
+    operators that the schemes use on Sage points. A `None` point is the
+    identity of either group.
+    """
+    __slots__ = ('_fast_point', '_order')
+
+    def __init__(self, point, order) -> None:
+        self._fast_point = point
+        self._order = order
+
+    def is_zero(self):
+        return self._fast_point is None or bn.is_inf(self._fast_point)
+
+    def __add__(self, other):
+        if self._fast_point is None:
+            return other
+        if other._fast_point is None:
+            return self
+        return FastPoint(bn.add(self._fast_point, other._fast_point), self._order)
+
+    def __neg__(self):
+        if self._fast_point is None:
+            return self
+        return FastPoint(bn.neg(self._fast_point), self._order)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __mul__(self, k):
+        if self._fast_point is None:
+            return self
+        return FastPoint(bn.multiply(self._fast_point, int(k) % self._order), self._order)
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        if not isinstance(other, FastPoint):
+            return False
+        if self._fast_point is None or other._fast_point is None:
+            return self.is_zero() and other.is_zero()
+        return bn.eq(self._fast_point, other._fast_point)
+
+    def __hash__(self):
+        if self.is_zero():
+            return 0
+        return hash(tuple(bn.normalize(self._fast_point)))
+
+    def __repr__(self) -> str:
+        if self.is_zero():
+            return "(0 : 1 : 0)"
+        return f"{bn.normalize(self._fast_point)}"
+
+
+class _ScalarField:
+    """
+    Integers modulo the group order
+    """
+    def __init__(self, order) -> None:
+        self._order = order
+
+    def __call__(self, val):
+        return int(val) % self._order
+
+    def order(self):
+        return self._order
+
+    def characteristic(self):
+        return self._order
+
+    def random_element(self):
+        return secrets.randbelow(self._order)
+
+
+class _ExtensionField:
+    """
+    Constructor of the FQ12 elements the target group lives in
+    """
+    def __call__(self, val):
+        return bn.FQ12.one() * int(val)
+
+
+class _FastPrecomp:
+    """
+    Stand-in for BNCurve's PrecomputedG2
+    """
+    __slots__ = ('_point',)
+
+    def __init__(self, point) -> None:
+        self._point = point
+
+    def point(self):
+        return self._point
+
+
+class FastBNCurve:
+    """
+    The BN254 curve from py_ecc, with G0 being py_ecc's G1 (over Fp) and
+    G1 being py_ecc's G2 (over Fp2).
+    """
+    def __init__(self) -> None:
+        if bn is None:
+            raise ImportError("FastBNCurve requires the py_ecc package")
+
+        self._order = bn.curve_order
+        self._scalar_field = _ScalarField(self._order)
+        self._extension_field = _ExtensionField()
+        self._identity = FastPoint(None, self._order)
+        self._g0 = FastPoint(bn.G1, self._order)
+        self._g1 = FastPoint(bn.G2, self._order)
+        self._neg_g1 = -self._g1
+        self._g1_precomp = _FastPrecomp(self._g1)
+        self._neg_g1_precomp = _FastPrecomp(self._neg_g1)
+        self._gt = bn.pairing(bn.G2, bn.G1)
+
+    def generators(self):
+        return (self.g0(), self.g1(), self.gt())
+
+    def order(self):
+        return self._order
+
+    def g0(self):
+        return self._g0
+
+    def g1(self):
+        return self._g1
+
+    def neg_g1(self):
+        return self._neg_g1
+
+    def gt(self):
+        return self._gt
+
+    def identity(self):
+        return self._identity
+
+    def base_field(self):
+        return bn.FQ
+
+    def extension_field(self):
+        return self._extension_field
+
+    def scalar_field(self):
+        return self._scalar_field
+
+    def mul_g0(self, k):
+        return self._g0 * k
+
+    def mul_g1(self, k):
+        return self._g1 * k
+
+    def scalar_mul_wnaf(self, P, k, w=5):
+        return P * k
+
+    def scalar_mul_fixed_base(self, k):
+        return self._g1 * k
+
+    def glv_mul(self, P, k):
+        return P * k
+
+    def mul_g0g1_batch(self, scalars):
+        return ([self._g0 * k for k in scalars], [self._g1 * k for k in scalars])
+
+    def pair_points(self, P, Q):
+        """
+        Compute the optimal ate pairing of a point P in G0 and a point Q
+        in G1
+        """
+        return self.prod_pair([(P, Q)])
+
+    def pair_many(self, pairs, max_workers=None):
+        return [self.pair_points(P, Q) for (P, Q) in pairs]
+
+    def pair_scalars(self, m, n):
+        return self.pair_points(self._g0 * m, self._g1 * n)
+
+    def pair_mixed(self, m, n):
+        P = m if hasattr(m, '_fast_point') else self._g0 * m
+        Q = n if hasattr(n, '_fast_point') else self._g1 * n
+        return self.pair_points(P, Q)
+
+    def pair(self, m, n):
+        return self.pair_mixed(m, n)
+
+    def multi_miller_loop(self, pairs):
+        """
+        Product of the Miller loops of a list of (P, Q), where Q is a
+        point of G1 or its precomputation
+        """
+        f = bn.FQ12.one()
+        for (P, Q) in pairs:
+            if isinstance(P, tuple):
+                P = FastPoint((bn.FQ(P[0]), bn.FQ(P[1]), bn.FQ.one()), self._order)
+            if isinstance(Q, _FastPrecomp):
+                Q = Q.point()
+            if P.is_zero() or Q.is_zero():
+                continue
+            f = f * bn.pairing(Q._fast_point, P._fast_point, final_exponentiate=False)
+        return f
+
+    @staticmethod
+    def gt_is_one(f):
+        return f == bn.FQ12.one()
+
+    def gt_pow(self, f, k):
+        return f ** (int(k) % self._order)
+
+    def gt_pow_wnaf(self, f, k, w=5):
+        return self.gt_pow(f, k)
+
+    def final_exp(self, f):
+        return bn.final_exponentiate(f)
+
+    def prod_pair(self, pairs):
+        """
+        Product of pairings with a single final exponentiation
+        """
+        return self.final_exp(self.multi_miller_loop(pairs))
+
+    def precompute_pairing_coeffs(self, Q, compile_kernel=False):
+        """
+        py_ecc has no entry point for cached line functions, so the
+        "precomputation" only wraps the point
+        """
+        return _FastPrecomp(Q)
+
+    def g1_precomp(self):
+        return self._g1_precomp
+
+    def neg_g1_precomp(self):
+        return self._neg_g1_precomp
+
+    def prod_pair_precomp(self, pairs):
+        return self.prod_pair(pairs)
+
+    def pair_with_precomp(self, P, precomp):
+        return self.prod_pair_precomp([(P, precomp)])
+
+    @staticmethod
+    def _hash_input_bytes(polyval):
+        if isinstance(polyval, (str)):
+            return polyval.encode('utf-8')
+        elif isinstance(polyval, (bytes)):
+            return polyval
+        elif isinstance(polyval, (int)):
+            return polyval.to_bytes((polyval.bit_length() + 7)//8, 'big')
+        else:
+            raise ValueError(f"hashing data of type {type(polyval)} not supported")
+
+    def _hash_input_encode(self, polyval):
+        val = FastBNCurve._hash_input_bytes(polyval)
+        h = sha256(len(val).to_bytes(8, 'big') + val).digest()
+        return int.from_bytes(h, 'big') % self._order
+
+    @functools.lru_cache(maxsize=1024)
+    def hash2g0_cached(self, m_bytes : bytes):
+        """
+        Memoized hash to G0 of a byte string, so that repeated tags and
+        messages are only hashed and multiplied out once
+        """
+        p = self._g0 * self._hash_input_encode(m_bytes)
+        assert not p.is_zero(), "hash of input is zero modulo the group order"
+        return p
+
+    @staticmethod
+    def clear_hash_cache():
+        FastBNCurve.hash2g0_cached.cache_clear()
+
+    def hash2g0(self, polyval):
+        """
+        An insecure hash to G0: unlike BNCurve.hash2g0, which maps the
+        hash onto the curve, the hash of the input is used as the
+        discrete log of the output.
+        """
+        return self.hash2g0_cached(FastBNCurve._hash_input_bytes(polyval))
+
+    def hash2g0_affine(self, polyval):
+        (x, y) = bn.normalize(self.hash2g0(polyval)._fast_point)
+        return (x.n, y.n)
+
+    def hash2g0_batch(self, polyvals):
+        return [self.hash2g0(v) for v in polyvals]
+
+    def hash2g1(self, polyval):
+        p = self._g1 * self._hash_input_encode(polyval)
+        assert not p.is_zero(), "hash of input is zero modulo the group order"
+        return p
+
+    def __repr__(self) -> str:
+        return f"{{Curve: py_ecc optimized_bn128, generators: {self.generators()} }}"
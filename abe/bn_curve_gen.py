@@ -9,8 +9,15 @@ from sage.rings.all import *
 from sage.rings.finite_rings.all import GF
 from sage.schemes.all import EllipticCurve
 from sage.arith.misc import kronecker_symbol
+from math import isqrt
 from sage.schemes.elliptic_curves.ell_point import EllipticCurvePoint_field
 from hashlib import sha256
+import functools
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from abe import fast_fp
+from abe.field_utils import batch_invert
 
 def find_min_x(m, func):
     x = 2**(m//4)
@@ -24,6 +31,309 @@ def find_min_x(m, func):
         else:
             x = 3*x//2
 
+def build_comb(P, bits, w):
+    """
+    Fixed-base comb table for P: for every window position i,
+    table[i][d] = d * 2^(w*i) * P for d < 2^w, covering scalars of up to
+    `bits` bits.
+    """
+    table = []
+    base = P
+    for _ in range((bits + w - 1)//w):
+        row = [0*base, base]
+        for _ in range(2, 1 << w):
+            row.append(row[-1] + base)
+        table.append(row)
+        for _ in range(w):
+            base = base + base
+    return table
+
+
+def comb_mul(table, k, identity):
+    """
+    Compute k*P from the comb table of P with one table lookup and one
+    addition per non-zero window of the non-negative integer `k`.
+    """
+    w = (len(table[0]) - 1).bit_length()
+    mask = (1 << w) - 1
+    k = int(k)
+    acc = identity
+    i = 0
+    while k:
+        digit = k & mask
+        if digit:
+            acc = acc + table[i][digit]
+        k >>= w
+        i += 1
+    return acc
+
+
+def wnaf(k, w):
+    """
+    Width-w NAF of the non-negative integer `k`, least significant digit
+    first. Non-zero digits are odd, below 2^(w-1) in absolute value, and
+    followed by at least w-1 zeros.
+    """
+    k = int(k)
+    digits = []
+    while k:
+        if k & 1:
+            d = k & ((1 << w) - 1)
+            if d >= 1 << (w - 1):
+                d -= 1 << w
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+
+def wnaf_mul(P, digits, identity):
+    """
+    Compute k*P from the w-NAF digits of k, as returned by `wnaf`. Only
+    the odd multiples of P up to the largest digit are precomputed.
+    """
+    if not digits:
+        return identity
+    top = max(abs(d) for d in digits)
+    odd = [P]
+    P2 = P + P
+    while 2*len(odd) - 1 < top:
+        odd.append(odd[-1] + P2)
+
+    acc = identity
+    for d in reversed(digits):
+        acc = acc + acc
+        if d > 0:
+            acc = acc + odd[d >> 1]
+        elif d < 0:
+            acc = acc - odd[(-d) >> 1]
+    return acc
+
+
+def _jacobian_double(X1, Y1, Z1):
+    """
+    Doubling on y^2 = x^3 + B in Jacobian coordinates (dbl-2009-l)
+    """
+    A = X1**2
+    B = Y1**2
+    C = B**2
+    D = 2*((X1 + B)**2 - A - C)
+    E = 3*A
+    X3 = E**2 - 2*D
+    Y3 = E*(D - X3) - 8*C
+    Z3 = 2*Y1*Z1
+    return (X3, Y3, Z3)
+
+
+def _jacobian_add_affine(X1, Y1, Z1, x2, y2):
+    """
+    Mixed addition of a Jacobian and an affine point on y^2 = x^3 + B
+    (madd-2007-bl). Z1 == 0 is the point at infinity.
+    """
+    if Z1 == 0:
+        return (x2, y2, x2**0)
+    Z1Z1 = Z1**2
+    U2 = x2*Z1Z1
+    S2 = y2*Z1*Z1Z1
+    H = U2 - X1
+    r = 2*(S2 - Y1)
+    if H == 0:
+        if r == 0:
+            return _jacobian_double(X1, Y1, Z1)
+        return (X1**0, X1**0, 0*Z1)
+    HH = H**2
+    I = 4*HH
+    J = H*I
+    V = X1*I
+    X3 = r**2 - J - 2*V
+    Y3 = r*(V - X3) - 2*Y1*J
+    Z3 = (Z1 + H)**2 - Z1Z1 - HH
+    return (X3, Y3, Z3)
+
+
+def _miller_lines(Q, n):
+    """
+    Run the Miller loop of f_{n,Q} once and record its line functions.
+    Every step is a tuple (double, lam, c, x_den): the numerator is the
+    line y - lam*x - c, or the vertical line x - c when `lam` is None,
+    and the denominator is the vertical line at `x_den` (absent when it
+    is None). `double` tells whether the accumulator is squared before
+    the step. Keeping the intercept c rather than a point of the line
+    makes the evaluation at (xP, yP) one product lam*xP, which is a
+    scalar product when P is in G0.
+    """
+    (xQ, yQ) = Q.xy()
+    (xT, yT) = (xQ, yQ)
+    lines = []
+    bits = Integer(n).bits()
+    for i in range(len(bits) - 2, -1, -1):
+        # Tangent at T and the vertical at 2T
+        lam = 3*xT**2 / (2*yT)
+        x2 = lam**2 - 2*xT
+        lines.append((True, lam, yT - lam*xT, x2))
+        (xT, yT) = (x2, lam*(xT - x2) - yT)
+
+        if bits[i]:
+            if xT == xQ:
+                # T = -Q, so T + Q is the point at infinity (last step)
+                lines.append((False, None, xT, None))
+                continue
+            # Chord through T and Q and the vertical at T + Q
+            lam = (yQ - yT) / (xQ - xT)
+            x3 = lam**2 - xT - xQ
+            lines.append((False, lam, yT - lam*xT, x3))
+            (xT, yT) = (x3, lam*(xT - x3) - yT)
+    return lines
+
+
+def _eval_lines_shared(pairs, one):
+    """
+    Evaluate several recorded Miller functions, given as a list of
+    ((xP, yP), lines), into a single fraction num/den. The lines of every
+    point come from the same loop over the bits of n, so the steps line
+    up and the accumulator is squared once per step for all of them.
+    """
+    (num, den) = (one, one)
+    for steps in zip(*(lines for (_, lines) in pairs)):
+        if steps[0][0]:
+            num = num*num
+            den = den*den
+        for (((xP, yP), _), (_, lam, c, x_den)) in zip(pairs, steps):
+            if lam is None:
+                num = num*(xP - c)
+            else:
+                num = num*(yP - lam*xP - c)
+                den = den*(xP - x_den)
+    return (num, den)
+
+
+class PrecomputedG2:
+    """
+    The line functions of the Miller loop of a fixed point Q in G1.
+    Pairings against Q only evaluate the lines, with no point arithmetic.
+    """
+    __slots__ = ('_point', '_lines', '_arrays', '_compile', '_kernel')
+
+    def __init__(self, point, lines, compile_kernel=False) -> None:
+        self._point = point
+        self._lines = lines
+        # Machine integer copy of the lines, see BNCurve._small_lines
+        self._arrays = None
+        # Miller loop compiled for these lines, see BNCurve._fixed_kernel.
+        # Compiling is only worth it for long-lived points, so it is
+        # opt-in.
+        self._compile = compile_kernel
+        self._kernel = None
+
+    def point(self):
+        return self._point
+
+    def lines(self):
+        return self._lines
+
+
+# Curve of the worker processes of BNCurve.pair_many
+_PAIR_WORKER_CURVE = None
+
+
+def _pair_worker_init(curve):
+    global _PAIR_WORKER_CURVE
+    _PAIR_WORKER_CURVE = curve
+
+
+def _fp12_ints(a):
+    return [int(c) for c in a.polynomial().list()]
+
+
+def _pair_worker(job):
+    """
+    pair_points on integer coordinates, run in a pair_many worker
+    """
+    curve = _PAIR_WORKER_CURVE
+    points = []
+    for xy in job:
+        if xy is None:
+            points.append(curve.identity())
+        else:
+            (x, y) = xy
+            points.append(curve.curve12()([curve.extension_field()(x), curve.extension_field()(y)]))
+    return _fp12_ints(curve.pair_points(points[0], points[1]))
+
+
+def _svdw_constants(Fp, B):
+    """
+    Constants of the Shallue-van de Woestijne map (RFC 9380, Section
+    6.6.1) for the curve y^2 = x^3 + B over `Fp`.
+    """
+    g = lambda x: x**3 + B
+    candidates = (Fp(k*s) for k in range(1, int(Fp.order())) for s in (1, -1))
+
+    for Z in candidates:
+        gz = g(Z)
+        if gz == 0:
+            continue
+        h = -(3*Z**2)/(4*gz)
+        if h == 0 or not h.is_square():
+            continue
+        if gz.is_square() or g(-Z/2).is_square():
+            break
+
+    c1 = gz
+    c2 = -Z/2
+    c3 = (-gz*(3*Z**2)).sqrt()
+    if int(c3) % 2 == 1:
+        c3 = -c3
+    c4 = -4*gz/(3*Z**2)
+    return (Z, c1, c2, c3, c4)
+
+
+def _svdw_denominator(u, constants):
+    """
+    The value (1 - c1 u^2)(1 + c1 u^2) that _svdw_map inverts
+    """
+    tv1 = u**2 * constants[1]
+    return (1 - tv1)*(1 + tv1)
+
+
+def _svdw_map(u, B, constants, tv3=None):
+    """
+    Map a field element `u` to an affine point (x, y) on y^2 = x^3 + B
+    with the Shallue-van de Woestijne map. There is no rejection loop:
+    every `u` maps to a point. `tv3` is the inverse of
+    _svdw_denominator(u) (zero if that is zero), for callers that
+    invert many denominators at once.
+    """
+    (Z, c1, c2, c3, c4) = constants
+    one = u**0
+
+    tv1 = u**2 * c1
+    tv2 = one + tv1
+    tv1 = one - tv1
+    if tv3 is None:
+        tv3 = tv1 * tv2
+        tv3 = 1/tv3 if tv3 != 0 else tv3
+    tv4 = u * tv1 * tv3 * c3
+
+    x1 = c2 - tv4
+    gx1 = x1**3 + B
+    if gx1.is_square():
+        x = x1
+    else:
+        x2 = c2 + tv4
+        gx2 = x2**3 + B
+        if gx2.is_square():
+            x = x2
+        else:
+            x = (tv2**2 * tv3)**2 * c4 + Z
+
+    y = (x**3 + B).sqrt()
+    if int(u) % 2 != int(y) % 2:
+        y = -y
+    return (x, y)
+
+
 class BNCurve:
     """
     An instance of a Barreto-Naehrig Curve
@@ -53,7 +363,17 @@ class BNCurve:
 
         # Sextic extension of Fp2
         self._Fp12  = self._Fp2.extension(6, name='T')
+
+        # Over a field whose characteristic fits in 31 bits, Miller loops
+        # on precomputed lines run on machine integers in Fp[T]/(m(T)),
+        # where m is the modulus of Fp12.
+        self._small_field = fast_fp.njit is not None and p < fast_fp._JIT_PRIME_BOUND
+        if self._small_field:
+            self._fp12_modulus = fast_fp.np.array(
+                [int(c) for c in self._Fp12.modulus().list()[:-1]], dtype=fast_fp.np.int64
+            )
         self._order = n
+        self._scalar_field = GF(n)
 
         # Base field curve
         self._curve = EllipticCurve(
@@ -66,6 +386,10 @@ class BNCurve:
         # degree-12 extension field curve
         self._curve12 = self._curve2.change_ring(self._Fp12)
 
+        # Point at infinity of the degree-12 curve; G0, G1 and the
+        # hash-to-group outputs all live on this curve.
+        self._identity12 = self._curve12([0, 1, 0])
+
         # Base field generator point
         self._g0 = self._curve12([1, y,1])
 
@@ -87,7 +411,236 @@ class BNCurve:
         else:
             self._g1 = g1_small
 
-        self._gt = self._g0.weil_pairing(self._g1, self._order)
+        # Used as the second argument of the product-of-pairings checks
+        self._neg_g1 = -self._g1
+        self._g1_precomp = self.precompute_pairing_coeffs(self._g1, compile_kernel=True)
+        self._neg_g1_precomp = self.precompute_pairing_coeffs(self._neg_g1)
+
+        # GLV endomorphism phi(x, y) = (beta*x, y), which acts on G0 as
+        # multiplication by lambda, a cube root of unity modulo n.
+        self._beta = self._Fp12(self._Fp.zeta(3))
+        lam = self._scalar_field.zeta(3)
+        if self.phi(self._g0) != lam*self._g0:
+            lam = lam**2
+        assert self.phi(self._g0) == lam*self._g0
+        self._lambda = Integer(lam)
+        self._glv_basis = BNCurve._glv_basis(self._order, self._lambda)
+
+        # E(Fp) has prime order n, so every Fp-rational point is in G0
+        # and hashing to G0 only needs a map from Fp to the curve.
+        self._B = self._Fp(B)
+        self._svdw = _svdw_constants(self._Fp, self._B)
+
+        # Exponent of the final exponentiation of the reduced Tate pairing
+        self._final_exp = (p**12 - 1) // n
+        # BN parameter u with p = p(u), and its NAF, used by the hard part
+        # of the final exponentiation. It is None if (p, n) is not of BN
+        # form, and then the final exponentiation is a plain power.
+        self._u = BNCurve._bn_parameter(p, n)
+        if self._u is not None:
+            u = self._u
+            self._u_naf = wnaf(abs(u), 2)
+            # The hard part computes the (p^4 - p^2 + 1)/n power times m
+            assert (2*u*(6*u**2 + 3*u + 1)) % n != 0
+
+        self._gt = self.pair_points(self._g0, self._g1)
+
+        # Fixed-base window tables for the two generators, used to turn
+        # scalar multiplication by g0/g1 into additions only.
+        bits = self._order.nbits()
+        self._g0_table = build_comb(self._g0, bits, BNCurve.WINDOW_BITS)
+        self._g1_table = build_comb(self._g1, bits, BNCurve.WINDOW_BITS)
+        self._g0_table_xy = BNCurve._affine_table(self._g0_table)
+        self._g1_table_xy = BNCurve._affine_table(self._g1_table)
+        # Built by scalar_mul_fixed_base
+        self._g1_wide_table = None
+        # Worker processes of pair_many, see _pair_pool
+        self._pair_executor = None
+        self._pair_executor_workers = None
+
+    # Width (in bits) of the windows of the fixed-base tables
+    WINDOW_BITS = 4
+    # Width of the windows of the table of scalar_mul_fixed_base
+    FIXED_BASE_BITS = 8
+    # Width of the NAF of the two halves of a GLV scalar
+    GLV_WNAF_BITS = 4
+    # Width of the NAF of the exponents in gt_pow
+    GT_WNAF_BITS = 4
+    # Fewest pairs for which pair_many starts worker processes by itself
+    PAIR_MANY_MIN_PARALLEL = 16
+
+    @staticmethod
+    def _affine_table(table):
+        # Entry 0 of every row is the identity, which is never looked up
+        return [[None] + [P.xy() for P in row[1:]] for row in table]
+
+    def _scalar_mul_fixed(self, P_table, k):
+        """
+        Compute k*P given the window table of P
+        """
+        return comb_mul(P_table, int(k) % int(self._order), self._identity12)
+
+    def phi(self, P):
+        """
+        The endomorphism (x, y) -> (beta*x, y) of the curve
+        """
+        if P == self._identity12:
+            return P
+        (x, y) = P.xy()
+        return self._curve12([self._beta*x, y])
+
+    @staticmethod
+    def _glv_basis(n, lam):
+        """
+        Two short vectors (a1, b1), (a2, b2) of the lattice
+        {(a, b) : a + b*lam = 0 mod n}, found with the extended Euclidean
+        algorithm on (n, lam) (Guide to ECC, Algorithm 3.74).
+        """
+        n = int(n)
+        lam = int(lam)
+        bound = isqrt(n)
+        (r0, r1) = (n, lam)
+        (t0, t1) = (0, 1)
+
+        while r1 >= bound:
+            q = r0 // r1
+            (r0, r1) = (r1, r0 - q*r1)
+            (t0, t1) = (t1, t0 - q*t1)
+
+        # r0 is the last remainder >= sqrt(n) and r1 the first below it
+        (a1, b1) = (r1, -t1)
+        q = r0 // r1
+        (r2, t2) = (r0 - q*r1, t0 - q*t1)
+        if r0**2 + t0**2 <= r2**2 + t2**2:
+            (a2, b2) = (r0, -t0)
+        else:
+            (a2, b2) = (r2, -t2)
+        return ((a1, b1), (a2, b2))
+
+    def glv_decompose(self, k):
+        """
+        Write k = k0 + k1*lambda mod n with |k0|, |k1| around sqrt(n)
+        """
+        n = int(self._order)
+        k = int(k) % n
+        ((a1, b1), (a2, b2)) = self._glv_basis
+        c1 = (2*b2*k + n) // (2*n)
+        c2 = (-2*b1*k + n) // (2*n)
+        k0 = k - c1*a1 - c2*a2
+        k1 = -c1*b1 - c2*b2
+        return (k0, k1)
+
+    def glv_mul(self, P, k):
+        """
+        Compute k*P for a point P in G0 as k0*P + k1*phi(P). The two
+        half-length scalars are recoded in w-NAF and processed in one
+        loop (interleaved w-NAF), so they share the doublings, and the
+        odd multiples of phi(P) are the images of those of P.
+        """
+        (k0, k1) = self.glv_decompose(k)
+        w = BNCurve.GLV_WNAF_BITS
+        naf0 = wnaf(abs(k0), w)
+        naf1 = wnaf(abs(k1), w)
+
+        odd = [P]
+        P2 = P + P
+        for _ in range(1, 1 << (w - 2)):
+            odd.append(odd[-1] + P2)
+        odd_phi = [self.phi(Q) for Q in odd]
+        if k0 < 0:
+            odd = [-Q for Q in odd]
+        if k1 < 0:
+            odd_phi = [-Q for Q in odd_phi]
+
+        acc = self._identity12
+        for i in range(max(len(naf0), len(naf1)) - 1, -1, -1):
+            acc = acc + acc
+            for (digits, table) in ((naf0, odd), (naf1, odd_phi)):
+                d = digits[i] if i < len(digits) else 0
+                if d > 0:
+                    acc = acc + table[d >> 1]
+                elif d < 0:
+                    acc = acc - table[(-d) >> 1]
+        return acc
+
+    def _scalar_mul_fixed_jacobian(self, P_table, k):
+        """
+        Same as _scalar_mul_fixed, but the sum is accumulated in Jacobian
+        coordinates. `P_table` holds the affine (x, y) of the window
+        table entries.
+        """
+        w = BNCurve.WINDOW_BITS
+        mask = (1 << w) - 1
+        k = int(k) % int(self._order)
+        one = self._Fp12(1)
+        acc = (one, one, 0*one)
+        i = 0
+        while k:
+            digit = k & mask
+            if digit:
+                (x, y) = P_table[i][digit]
+                acc = _jacobian_add_affine(acc[0], acc[1], acc[2], x, y)
+            k >>= w
+            i += 1
+        return acc
+
+    def batch_normalize(self, points):
+        """
+        Convert a list of Jacobian (X, Y, Z) triples into points of the
+        degree-12 curve, sharing one field inversion among all of them.
+        """
+        z_invs = batch_invert([Z for (_, _, Z) in points])
+        result = []
+        for ((X, Y, Z), z_inv) in zip(points, z_invs):
+            if Z == 0:
+                result.append(self._identity12)
+                continue
+            z_inv2 = z_inv**2
+            result.append(self._curve12.point([X*z_inv2, Y*z_inv2*z_inv, 1], check=False))
+        return result
+
+    def mul_g0g1_batch(self, scalars):
+        """
+        Compute ([k*g0 for k in scalars], [k*g1 for k in scalars]). The
+        fixed-base sums are kept in Jacobian coordinates and normalized
+        together, so the whole batch costs one field inversion instead of
+        one per point addition.
+        """
+        jac0 = [self._scalar_mul_fixed_jacobian(self._g0_table_xy, k) for k in scalars]
+        jac1 = [self._scalar_mul_fixed_jacobian(self._g1_table_xy, k) for k in scalars]
+        return (self.batch_normalize(jac0), self.batch_normalize(jac1))
+
+    def scalar_mul_wnaf(self, P, k, w=5):
+        """
+        Compute k*P for an arbitrary point P from the width-w NAF of k
+        modulo n: one doubling per bit and one addition or subtraction
+        of an odd multiple of P per non-zero digit.
+        """
+        return wnaf_mul(P, wnaf(int(k) % int(self._order), w), self._identity12)
+
+    def scalar_mul_fixed_base(self, k):
+        """
+        Compute k*g1 with a comb table of FIXED_BASE_BITS-bit windows. The
+        table is larger than the one of mul_g1 and needs fewer additions,
+        so it is only built on first use.
+        """
+        if self._g1_wide_table is None:
+            self._g1_wide_table = build_comb(
+                self._g1, self._order.nbits(), BNCurve.FIXED_BASE_BITS
+            )
+        return self._scalar_mul_fixed(self._g1_wide_table, k)
+
+    def mul_g0(self, k):
+        """
+        Compute k*g0 using the precomputed window table of g0
+        """
+        return self._scalar_mul_fixed(self._g0_table, k)
+
+    def mul_g1(self, k):
+        """
+        Compute k*g1 using the precomputed window table of g1
+        """
+        return self._scalar_mul_fixed(self._g1_table, k)
 
     def curve(self):
         return self._curve
@@ -110,9 +663,15 @@ class BNCurve:
     def g1(self):
         return self._g1
 
+    def neg_g1(self):
+        return self._neg_g1
+
     def gt(self):
         return self._gt
 
+    def identity(self):
+        return self._identity12
+
     def base_field(self):
         return self._Fp
 
@@ -120,54 +679,476 @@ class BNCurve:
         return self._Fp12
 
     def scalar_field(self):
-        return GF(self._order)
+        return self._scalar_field
 
-    def pair(self, m, n):
+    @staticmethod
+    def _bn_parameter(p, n):
+        """
+        The u with p = 36u^4 + 36u^3 + 24u^2 + 6u + 1 and trace
+        p + 1 - n = 6u^2 + 1, or None if there is none
+        """
+        t = p + 1 - n
+        if t < 1 or (t - 1) % 6 != 0:
+            return None
+        u = isqrt(int(t - 1) // 6)
+        for u in (u, -u):
+            if _bn_p(u) == p:
+                return u
+        return None
+
+    def curve_parameters(self):
+        """
+        The BN parameter u and its NAF (least significant digit first)
+        """
+        if self._u is None:
+            return None
+        return (self._u, self._u_naf)
+
+    def miller_loop(self, P, Q):
+        """
+        The Miller function f_{n,P}(Q) of the reduced Tate pairing
         """
-        Compute the weil paring
+        if P == self._identity12 or Q == self._identity12:
+            return self._Fp12(1)
+        return P._miller_(Q, self._order)
+
+    def pair_points(self, P, Q):
+        """
+        Compute the reduced Tate pairing of a point P in G0 and a point Q
+        in G1: one Miller loop f_{n,P}(Q) followed by the final
+        exponentiation to (p^12 - 1)/n. A Weil pairing needs two Miller
+        loops, so this is about twice as fast. The argument order matters:
+        the Miller function is built from the base field point P and
+        evaluated at the extension field point Q.
+        """
+        return self.final_exp(self.miller_loop(P, Q))
+
+    def pair_many(self, pairs, max_workers=None):
+        """
+        [pair_points(P, Q) for (P, Q) in pairs]. When there are at least
+        PAIR_MANY_MIN_PARALLEL pairs, or the caller asks for max_workers,
+        the pairings are computed in worker processes. The workers are
+        forked, so they inherit the curve, and only the integer
+        coordinates of the points and of the results are sent between
+        processes. The pool is created once per curve and reused.
+        Platforms without a safe fork start method stay serial.
+        """
+        if max_workers is None and len(pairs) < BNCurve.PAIR_MANY_MIN_PARALLEL:
+            max_workers = 1
+        pool = None if max_workers == 1 or len(pairs) < 2 else self._pair_pool(max_workers)
+        if pool is None:
+            return [self.pair_points(P, Q) for (P, Q) in pairs]
+
+        def coordinates(P):
+            if P == self._identity12:
+                return None
+            (x, y) = P.xy()
+            return (_fp12_ints(x), _fp12_ints(y))
+
+        jobs = [(coordinates(P), coordinates(Q)) for (P, Q) in pairs]
+        results = list(pool.map(_pair_worker, jobs))
+        return [self._Fp12(f) for f in results]
+
+    def _pair_pool(self, max_workers):
+        """
+        The worker pool of pair_many, or None without a fork start
+        method (Windows) or where forking is unsafe (macOS)
+        """
+        if sys.platform == "darwin" or "fork" not in multiprocessing.get_all_start_methods():
+            return None
+        if self._pair_executor is not None and self._pair_executor_workers != max_workers:
+            self._pair_executor.shutdown()
+            self._pair_executor = None
+        if self._pair_executor is None:
+            self._pair_executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("fork"),
+                initializer=_pair_worker_init,
+                initargs=(self,)
+            )
+            self._pair_executor_workers = max_workers
+        return self._pair_executor
+
+    def pair_scalars(self, m, n):
+        """
+        Compute the pairing of m*g0 and n*g1
+        """
+        return self.pair_points(self.mul_g0(m), self.mul_g1(n))
+
+    def pair_mixed(self, m, n):
+        """
+        Compute the paring, where each argument is either a point or a
+        scalar multiplier of the corresponding generator
         """
         if isinstance(m, (EllipticCurvePoint_field)):
             P = m
         else:
-            P = m * self._g0
+            P = self.mul_g0(m)
 
         if isinstance(n, (EllipticCurvePoint_field)):
             Q = n
         else:
-            Q = n * self._g1
+            Q = self.mul_g1(n)
 
-        return P.weil_pairing(Q, self._order)
+        return self.pair_points(P, Q)
 
-    def _hash_input_encode(self, polyval):
+    def pair(self, m, n):
+        """
+        Compute the paring. Callers that know the types of their
+        arguments should use pair_points or pair_scalars directly.
+        """
+        return self.pair_mixed(m, n)
+
+    def prod_pair(self, pairs):
+        """
+        Compute the product of reduced Tate pairings prod e(P_i, Q_i) for
+        a list of (P_i, Q_i) points. The Miller loop outputs are
+        multiplied together and a single final exponentiation is shared
+        by all of them.
+        """
+        f = self._Fp12(1)
+        for (P, Q) in pairs:
+            f = f * self.miller_loop(P, Q)
+        return self.final_exp(f)
+
+    def precompute_pairing_coeffs(self, Q, compile_kernel=False):
+        """
+        Record the Miller loop lines of a point Q in G1 that is paired
+        many times, e.g., a public key or the generator g1. With
+        `compile_kernel`, single pairings against Q on the small-field
+        path run a kernel compiled once for Q's lines.
+        """
+        if Q == self._identity12:
+            return PrecomputedG2(Q, None)
+        return PrecomputedG2(Q, _miller_lines(Q, self._order), compile_kernel)
+
+    def g1_precomp(self):
+        return self._g1_precomp
+
+    def neg_g1_precomp(self):
+        return self._neg_g1_precomp
+
+    def multi_miller_loop(self, pairs):
+        """
+        The product of the Miller functions f_{n,Q_i}(P_i) for a list of
+        (P_i, Q_i), where every Q_i is a point of G1 or its
+        PrecomputedG2, and every P_i is a point of G0 or its affine
+        coordinates as a pair of ints (see hash2g0_affine). All the loops
+        run in lockstep on one accumulator, so a doubling step squares
+        once for the whole product, and the numerators and denominators
+        share a single inversion. This is the reduced Tate pairing with
+        the roles of the arguments swapped: its Miller function is built
+        from Q, so precomputed lines can be reused. It is bilinear and
+        non-degenerate, but it is not equal to pair_points, so the two
+        must not be mixed in one equation.
+        """
+        one = self._Fp12(1)
+        active = []
+        for (P, Q) in pairs:
+            if Q is self._g1:
+                Q = self._g1_precomp
+            elif not isinstance(Q, PrecomputedG2):
+                Q = self.precompute_pairing_coeffs(Q)
+            if Q.lines() is None:
+                continue
+            if isinstance(P, tuple):
+                active.append((P, Q))
+                continue
+            if P == self._identity12:
+                continue
+            active.append((P.xy(), Q))
+
+        if self._small_field and active:
+            f = self._multi_miller_loop_small(active)
+            if f is not None:
+                return f
+
+        (num, den) = _eval_lines_shared(
+            [(xy, precomp.lines()) for (xy, precomp) in active], one
+        )
+        return num/den
+
+    def _fp12_coeffs(self, a):
+        c = [int(v) for v in a.polynomial().list()]
+        return c + [0]*(self._fp12_modulus.shape[0] - len(c))
+
+    def _small_lines(self, precomp):
+        """
+        The lam, c and x_den coefficients of the lines of `precomp` as
+        int64 arrays, converted once per PrecomputedG2
+        """
+        if precomp._arrays is None:
+            np = fast_fp.np
+            zero = [0]*self._fp12_modulus.shape[0]
+            lines = precomp.lines()
+            precomp._arrays = tuple(
+                np.array(
+                    [zero if step[i] is None else self._fp12_coeffs(step[i]) for step in lines],
+                    dtype=np.int64
+                )
+                for i in range(1, 4)
+            )
+        return precomp._arrays
+
+    def _fixed_kernel(self, precomp):
+        """
+        The small-field Miller loop of a single point against the lines
+        of `precomp`, compiled once per PrecomputedG2 that opted in with
+        compile_kernel, with the lines as constants
+        """
+        if precomp._kernel is None:
+            np = fast_fp.np
+            (lam, c, x_den) = (a[np.newaxis] for a in self._small_lines(precomp))
+            precomp._kernel = fast_fp.fixed_miller_loop(
+                *self._small_steps(precomp), lam, c, x_den,
+                self._fp12_modulus, int(self._Fp.order())
+            )
+        return precomp._kernel
+
+    @staticmethod
+    def _small_steps(precomp):
+        np = fast_fp.np
+        lines = precomp.lines()
+        double = np.array([1 if step[0] else 0 for step in lines], dtype=np.int64)
+        vertical = np.array([1 if step[1] is None else 0 for step in lines], dtype=np.int64)
+        return (double, vertical)
+
+    def _multi_miller_loop_small(self, active):
+        """
+        multi_miller_loop on machine integers with fast_fp. Returns None
+        if some P is not Fp-rational, i.e., not in G0.
+        """
+        np = fast_fp.np
+        xs = []
+        ys = []
+        for ((xP, yP), _) in active:
+            if isinstance(xP, int):
+                xs.append(xP)
+                ys.append(yP)
+                continue
+            (cx, cy) = (self._fp12_coeffs(xP), self._fp12_coeffs(yP))
+            if any(cx[1:]) or any(cy[1:]):
+                return None
+            xs.append(cx[0])
+            ys.append(cy[0])
+
+        k = self._fp12_modulus.shape[0]
+        num = np.zeros(k, dtype=np.int64)
+        den = np.zeros(k, dtype=np.int64)
+        (xs, ys) = (np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64))
+        if len(active) == 1 and active[0][1]._compile:
+            self._fixed_kernel(active[0][1])(xs, ys, num, den)
+        else:
+            (double, vertical) = BNCurve._small_steps(active[0][1])
+            arrays = [self._small_lines(precomp) for (_, precomp) in active]
+            (lam, c, x_den) = (np.stack([a[i] for a in arrays]) for i in range(3))
+            fast_fp.miller_loop_small(
+                xs, ys, double, vertical, lam, c, x_den,
+                self._fp12_modulus, int(self._Fp.order()), num, den
+            )
+        return self._Fp12([int(c) for c in num]) / self._Fp12([int(c) for c in den])
+
+    def gt_pow(self, f, k):
+        """
+        Compute f^k for f in GT with gt_pow_wnaf and the default window
+        """
+        return self.gt_pow_wnaf(f, k, BNCurve.GT_WNAF_BITS)
+
+    def gt_pow_wnaf(self, f, k, w=5):
+        """
+        Compute f^k for f in GT from the width-w NAF of k modulo n. The
+        odd powers of f up to the largest digit and their inverses are
+        precomputed, the inverses with a single field inversion, so the
+        negative digits cost no more than the positive ones. Wider
+        windows pay off for larger group orders.
+        """
+        digits = wnaf(int(k) % int(self._order), w)
+        acc = self._Fp12(1)
+        if not digits:
+            return acc
+        top = max(abs(d) for d in digits)
+        odd = [f]
+        f2 = f*f
+        while 2*len(odd) - 1 < top:
+            odd.append(odd[-1]*f2)
+        odd_inv = batch_invert(odd)
+
+        for d in reversed(digits):
+            acc = acc*acc
+            if d > 0:
+                acc = acc*odd[d >> 1]
+            elif d < 0:
+                acc = acc*odd_inv[(-d) >> 1]
+        return acc
+
+    @staticmethod
+    def gt_is_one(f):
+        """
+        Whether f is the identity of GT, without building a field element
+        to compare against
+        """
+        return f.is_one()
+
+    def final_exp(self, f):
+        """
+        The final exponentiation of the reduced pairing. For BN curves it
+        is split into the easy part f^((p^6 - 1)(p^2 + 1)), made of
+        Frobenius maps and one inversion, and the hard part, which is
+        computed from three powers by u. The result is
+        f^(m (p^12 - 1)/n) with m = 2u(6u^2 + 3u + 1) prime to n, so the
+        pairing stays bilinear and non-degenerate.
+        """
+        if self._u is None or f == 0:
+            return f**self._final_exp
+        return self._final_exp_hard(BNCurve._final_exp_easy(f))
+
+    @staticmethod
+    def _final_exp_easy(f):
+        """
+        f^((p^6 - 1)(p^2 + 1)); the result is in the cyclotomic subgroup
+        """
+        f = f.frobenius(6) / f
+        return f.frobenius(2) * f
+
+    def _pow_u(self, f):
+        """
+        f^u for f in the cyclotomic subgroup, from the NAF of |u|. The
+        inverses there are the conjugates f^(p^6), but Fp12 is an
+        absolute extension, where that Frobenius power costs more than a
+        plain inversion.
+        """
+        f_inv = 1/f
+        acc = self._Fp12(1)
+        for d in reversed(self._u_naf):
+            acc = acc*acc
+            if d > 0:
+                acc = acc*f
+            elif d < 0:
+                acc = acc*f_inv
+        return 1/acc if self._u < 0 else acc
+
+    def _final_exp_hard(self, f):
+        """
+        The hard part of Fuentes-Castaneda, Knapp and Rodriguez-Henriquez
+        (Faster hashing to G2, SAC 2011): f raised to
+        m (p^4 - p^2 + 1)/n = l0 + l1 p + l2 p^2 + l3 p^3 with
+
+            l0 = 1 + 6u + 12u^2 + 12u^3
+            l1 = 4u + 6u^2 + 12u^3
+            l2 = 6u + 6u^2 + 12u^3
+            l3 = -1 + 4u + 6u^2 + 12u^3
+        """
+        a = self._pow_u(f)
+        a = a*a                         # f^(2u)
+        b = a*a                         # f^(4u)
+        c = b*a                         # f^(6u)
+        d = self._pow_u(c)              # f^(6u^2)
+        e = self._pow_u(d)
+        common = e*e*d                  # f^(6u^2 + 12u^3)
+        l1 = common*b
+        l2 = common*c
+        l3 = l1/f
+        l0 = l2*d*f
+        return l0 * l1.frobenius(1) * l2.frobenius(2) * l3.frobenius(3)
+
+    def prod_pair_precomp(self, pairs):
+        """
+        Compute prod e'(P_i, Q_i) for a list of (P_i, precomp_i) where
+        precomp_i = precompute_pairing_coeffs(Q_i), and e' is the pairing
+        of multi_miller_loop.
+        """
+        return self.final_exp(self.multi_miller_loop(pairs))
+
+    def pair_with_precomp(self, P, precomp):
+        """
+        e'(P, Q) for Q given by its precomputed lines (see
+        prod_pair_precomp). This single-pair loop is the one place the
+        compiled kernel of a compile_kernel precomp, such as
+        g1_precomp(), runs; products of several pairs use the generic
+        kernel.
+        """
+        return self.prod_pair_precomp([(P, precomp)])
+
+    @staticmethod
+    def _hash_input_bytes(polyval):
         if isinstance(polyval, (str)):
-            val = polyval.encode('utf-8')
+            return polyval.encode('utf-8')
         elif isinstance(polyval, (bytes)):
-            val = polyval
+            return polyval
         elif isinstance(polyval, (int, Integer)):
-            len = (polyval.bit_length() + 7)//8
-            val = polyval.to_bytes(len)
+            length = (polyval.bit_length() + 7)//8
+            return int(polyval).to_bytes(length, 'big')
         else:
             raise ValueError(f"hashing data of type {type(polyval)} not supported")
 
-        h = sha256(val).digest()
+    def _hash_input_encode(self, polyval):
+        """
+        Hash the input to a scalar that is already reduced modulo the
+        group order. The hashed bytes are prefixed with their length so
+        that a single SHA-256 pass is enough for any input.
+        """
+        return BNCurve._hash_digest(BNCurve._hash_input_bytes(polyval)) % self._order
+
+    @staticmethod
+    def _hash_digest(val):
+        h = sha256(len(val).to_bytes(8, 'big') + val).digest()
+        return Integer(int.from_bytes(h, 'big'))
+
+    @functools.lru_cache(maxsize=1024)
+    def _hash2g0_xy(self, m_bytes : bytes):
+        u = self._Fp(BNCurve._hash_digest(m_bytes))
+        (x, y) = _svdw_map(u, self._B, self._svdw)
+        return (int(x), int(y))
+
+    @functools.lru_cache(maxsize=1024)
+    def hash2g0_cached(self, m_bytes : bytes):
+        """
+        Memoized hash to G0 of a byte string. Signing or verifying the
+        same message repeatedly only maps it to the curve once. The map
+        always lands on the curve, so the point is built without
+        checking the curve equation.
+        """
+        (x, y) = self._hash2g0_xy(m_bytes)
+        return self._curve12.point([x, y, 1], check=False)
+
+    @staticmethod
+    def clear_hash_cache():
+        BNCurve._hash2g0_xy.cache_clear()
+        BNCurve.hash2g0_cached.cache_clear()
 
-        return int.from_bytes(h)
+    def hash2g0_affine(self, polyval):
+        """
+        The affine coordinates of hash2g0(polyval) as a pair of ints,
+        which multi_miller_loop takes in place of the point
+        """
+        return self._hash2g0_xy(BNCurve._hash_input_bytes(polyval))
 
     def hash2g0(self, polyval):
         """
-        A simple but insecure hash to group G0 implementation. The
-        function just computes the hash of the input and uses that hash
-        the discrete log. This is clearly as insecure as things can get,
-        but it's simple to implement and also works with extension field
-        curves
+        Hash to group G0. The SHA-256 hash of the input is reduced to an
+        element of Fp and mapped to the curve with the Shallue-van de
+        Woestijne map of RFC 9380, so there is no rejection loop and the
+        discrete log of the output is not known. The reduction of the
+        hash is biased and the map is not constant time, so this is
+        still not fit for real world use.
         """
-        val = self._hash_input_encode(polyval)
-        while True:
-            p = self.scalar_field()(val)*self.g0()
-            if p == self.curve()([0, 1, 0]):
-                val = self._hash_input_encode(val)
-            else:
-                return p
+        return self.hash2g0_cached(BNCurve._hash_input_bytes(polyval))
+
+    def hash2g0_batch(self, polyvals):
+        """
+        hash2g0 of every input in `polyvals`. Repeated inputs are hashed
+        once, and the field inversions of the Shallue-van de Woestijne
+        maps of the distinct inputs share a single inversion.
+        """
+        keys = [BNCurve._hash_input_bytes(v) for v in polyvals]
+        distinct = list(dict.fromkeys(keys))
+        us = [self._Fp(BNCurve._hash_digest(m)) for m in distinct]
+        inverses = batch_invert([_svdw_denominator(u, self._svdw) for u in us])
+        points = dict()
+        for (m, u, tv3) in zip(distinct, us, inverses):
+            (x, y) = _svdw_map(u, self._B, self._svdw, tv3)
+            points[m] = self._curve12.point([x, y, 1], check=False)
+        return [points[m] for m in keys]
 
     def hash2g1(self, polyval):
         """
@@ -176,30 +1157,30 @@ class BNCurve:
         as the discrete log. This is clearly as insecure as things can
         get.
         """
-
         val = self._hash_input_encode(polyval)
-        while True:
-            p = self.scalar_field()(val)*self.g1()
-            if p == self.curve12()([0, 1, 0]):
-                val = self._hash_input_encode(val)
-            else:
-                return p
+        p = self._scalar_field(val)*self._g1
+        assert p != self._identity12, "hash of input is zero modulo the group order"
+        return p
 
     def __repr__(self) -> str:
         return f"{{Curve: {self._curve12}, generators: {self.generators()} }}"
 
 
+def _bn_p(x):
+    """
+    p(x) = 36x^4 + 36x^3 + 24x^2 + 6x + 1 in Horner form over Python
+    integers
+    """
+    return (((36*x + 36)*x + 24)*x + 6)*x + 1
+
+
 def bn_curve_gen(curve_order_in_bits) -> BNCurve:
     """
     Implements Algorithm-1 (Page 5) from the paper
     https://www.microsoft.com/en-us/research/wp-content/uploads/2016/02/pfcpo.pdf
     """
 
-    Z = ZZ['H']
-    var_x = Z.gen()
-    poly_p = 36*(var_x**4) + 36*(var_x**3) + 24*(var_x**2) + 6*var_x + 1
-
-    x = find_min_x(curve_order_in_bits, poly_p)
+    x = find_min_x(curve_order_in_bits, _bn_p)
 
     p = None
     n = None
@@ -207,13 +1188,13 @@ def bn_curve_gen(curve_order_in_bits) -> BNCurve:
 
     while True:
         t = 6*(x**2) + 1
-        p = poly_p(-1*x)
+        p = Integer(_bn_p(-1*x))
         n = p + 1 - t
 
         if p.is_prime() and n.is_prime():
             break
 
-        p = poly_p(x)
+        p = Integer(_bn_p(x))
         n = p + 1 - t
 
         if p.is_prime() and n.is_prime():
@@ -254,19 +1235,85 @@ def curve_32() -> BNCurve:
 if __name__=='__main__':
     def test_hash():
         c = curve_32()
+        BNCurve.clear_hash_cache()
         g1 = c.hash2g0("this is a test")
         g2 = c.hash2g0(b"this is a test")
-        g3 = c.hash2g0(int.from_bytes(b"this is a test"))
+        g3 = c.hash2g0(int.from_bytes(b"this is a test", 'big'))
         assert g1 == g2
         assert g1 == g3
 
         h1 = c.hash2g1("this is a test")
         h2 = c.hash2g1(b"this is a test")
-        h3 = c.hash2g1(int.from_bytes(b"this is a test"))
+        h3 = c.hash2g1(int.from_bytes(b"this is a test", 'big'))
         assert h1 == h2
         assert h3 == h1
 
+    def test_hash_batch():
+        c = curve_32()
+        msgs = ["a", b"b", "a", 12345, "c"]
+        assert c.hash2g0_batch(msgs) == [c.hash2g0(m) for m in msgs]
+
+    def test_precomp():
+        c = curve_32()
+        a = c.scalar_field().random_element()
+        g1_precomp = c.precompute_pairing_coeffs(c.g1())
+        e = c.pair_with_precomp(c.g0(), g1_precomp)
+        assert e != c.extension_field()(1)
+        assert c.pair_with_precomp(c.mul_g0(a), g1_precomp) == e**a
+        assert c.pair_with_precomp(c.g0(), c.precompute_pairing_coeffs(c.mul_g1(a))) == e**a
+        assert c.gt_is_one(c.prod_pair_precomp([(c.g0(), g1_precomp), (c.g0(), c.neg_g1_precomp())]))
+        assert c.multi_miller_loop([(c.g0(), c.g1())]) == c.multi_miller_loop([(c.g0(), g1_precomp)])
+        H = c.hash2g0("precomp")
+        assert c.hash2g0_affine("precomp") == tuple(int(v) for v in H.xy())
+        assert c.multi_miller_loop([(c.hash2g0_affine("precomp"), g1_precomp)]) == \
+            c.multi_miller_loop([(H, g1_precomp)])
+        assert c.multi_miller_loop([(c.hash2g0_affine("precomp"), c.identity())]) == 1
+
+    def test_final_exp():
+        c = curve_32()
+        (u, _) = c.curve_parameters()
+        assert u == -107
+        m = 2*u*(6*u**2 + 3*u + 1)
+        f = c.extension_field().random_element()
+        assert c.final_exp(f) == f**(c._final_exp * m)
+
+    def test_small_field():
+        # Curves with p < 2^31 evaluate the Miller lines with fast_fp
+        c = bn_curve_gen(28)
+        if not c._small_field:
+            return
+        P = c.hash2g0("small field")
+        precomp = c.precompute_pairing_coeffs(c.g1())
+        (num, den) = _eval_lines_shared([(P.xy(), precomp.lines())], c.extension_field()(1))
+        assert c.multi_miller_loop([(P, precomp)]) == num/den
+
+    def test_scalar_mul():
+        c = curve_32()
+        P = c.hash2g0("scalar mul")
+        for k in [0, 1, 2, c.order() - 1, c.scalar_field().random_element()]:
+            assert c.scalar_mul_wnaf(P, k) == int(k)*P
+            assert c.scalar_mul_wnaf(c.g1(), k, w=3) == int(k)*c.g1()
+            assert c.scalar_mul_fixed_base(k) == c.mul_g1(k)
+
+    def test_pair_many():
+        c = curve_32()
+        pairs = [(c.mul_g0(k), c.mul_g1(k + 1)) for k in range(1, 4)]
+        assert c.pair_many(pairs, max_workers=2) == [c.pair_points(P, Q) for (P, Q) in pairs]
+
+    def test_gt_pow():
+        c = curve_32()
+        for k in [0, 1, 2, 7, c.order() - 1, c.scalar_field().random_element()]:
+            assert c.gt_pow(c.gt(), k) == c.gt()**int(k)
+            assert c.gt_pow_wnaf(c.gt(), k) == c.gt()**int(k)
+
     def main():
         test_hash()
+        test_hash_batch()
+        test_precomp()
+        test_final_exp()
+        test_small_field()
+        test_scalar_mul()
+        test_gt_pow()
+        test_pair_many()
 
     main()
\ No newline at end of file
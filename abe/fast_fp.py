@@ -0,0 +1,166 @@
+#
+# Machine-word arithmetic in Fp and in Fp12 = Fp[T]/(m(T)) for curves
+# whose characteristic fits in 31 bits, so that the product of two
+# residues fits in an int64. The kernels are compiled with Numba when it
+# is installed and are only used then. They release the GIL, so they
+# can run in threads alongside other work.
+#
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Largest prime for which products of two residues fit in an int64. The
+# other modules' Numba kernels import it from here, together with np and
+# njit.
+_JIT_PRIME_BOUND = 2**31
+# Largest prime for which a product plus a residue fits in a uint64, for
+# plain NumPy arithmetic
+_NUMPY_PRIME_BOUND = 2**32
+
+
+def fp_add(a, b, p):
+    return (a + b) % p
+
+
+def fp_sub(a, b, p):
+    return (a - b) % p
+
+
+def fp_mul(a, b, p):
+    return (a * b) % p
+
+
+def poly_mul(a, b, n, p, out):
+    """
+    out[:2n - 1] = a[:n]*b[:n] as polynomials over Fp, schoolbook.
+    """
+    for i in range(2*n - 1):
+        out[i] = 0
+    for i in range(n):
+        if a[i] == 0:
+            continue
+        for j in range(n):
+            out[i + j] = fp_add(out[i + j], fp_mul(a[i], b[j], p), p)
+
+
+def poly_mul_karatsuba(a, b, k, p, prod):
+    """
+    prod[:2k - 1] = a[:k]*b[:k] with one Karatsuba step, three
+    half-size schoolbook products instead of four. `prod` is scratch
+    space of length 4k; its tail holds the half-size operands.
+    """
+    if k % 2 == 1:
+        poly_mul(a, b, k, p, prod)
+        return
+    h = k // 2
+    sa = prod[2*k:2*k + h]
+    sb = prod[2*k + h:3*k]
+    z = prod[3*k:4*k - 1]
+    # Low and high products land in disjoint halves of prod
+    poly_mul(a, b, h, p, prod)
+    prod[2*h - 1] = 0
+    poly_mul(a[h:], b[h:], h, p, prod[2*h:])
+    # Middle: (a0 + a1)(b0 + b1) - a0*b0 - a1*b1, shifted by h
+    for i in range(h):
+        sa[i] = fp_add(a[i], a[h + i], p)
+        sb[i] = fp_add(b[i], b[h + i], p)
+    poly_mul(sa, sb, h, p, z)
+    for i in range(2*h - 1):
+        z[i] = fp_sub(fp_sub(z[i], prod[i], p), prod[2*h + i], p)
+    for i in range(2*h - 1):
+        prod[h + i] = fp_add(prod[h + i], z[i], p)
+
+
+def fp12_mul(a, b, modulus, p, prod, out):
+    """
+    out = a*b in Fp[T]/(m(T)), where m is monic of degree k and `modulus`
+    holds its k low coefficients. `prod` is scratch space of length 4k.
+    """
+    k = modulus.shape[0]
+    poly_mul_karatsuba(a, b, k, p, prod)
+    # T^k = -sum(m_j T^j)
+    for i in range(2*k - 2, k - 1, -1):
+        c = prod[i]
+        if c == 0:
+            continue
+        for j in range(k):
+            prod[i - k + j] = fp_sub(prod[i - k + j], fp_mul(c, modulus[j], p), p)
+    for i in range(k):
+        out[i] = prod[i]
+
+
+def miller_loop_small(xPs, yPs, double, vertical, lam, c, x_den, modulus, p, num, den):
+    """
+    Evaluate the recorded Miller lines of several points Q_j at the
+    points P_j = (xPs[j], yPs[j]) of E(Fp), in lockstep as in
+    bn_curve_gen._eval_lines_shared. Step s of pair j is the line
+    y - lam[j, s]*x - c[j, s] over the vertical at x_den[j, s], or the
+    vertical x - c[j, s] when vertical[s] is set; the accumulator is
+    squared first when double[s] is set. As xP is in Fp, lam*xP is a
+    scalar product. The Fp12 numerator and denominator are written to
+    `num` and `den`.
+
+    A vertical step has lam and x_den zero, so both kinds of step are
+    evaluated by the same code, with the flag as a 0/1 multiplier:
+    the numerator is (1 - v)*yP + v*xP - lam*xP - c and the denominator
+    (1 - v)*(xP - x_den) + v. Only the squaring, which follows the bits
+    of the public n, is branched on.
+    """
+    k = modulus.shape[0]
+    prod = np.zeros(4*k, dtype=np.int64)
+    t = np.zeros(k, dtype=np.int64)
+    for i in range(k):
+        num[i] = 0
+        den[i] = 0
+    num[0] = 1
+    den[0] = 1
+
+    for s in range(double.shape[0]):
+        if double[s]:
+            fp12_mul(num, num, modulus, p, prod, num)
+            fp12_mul(den, den, modulus, p, prod, den)
+        v = vertical[s]
+        for j in range(xPs.shape[0]):
+            xP = xPs[j]
+            yP = yPs[j]
+            # t = (1 - v)*yP + v*xP - lam*xP - c
+            for i in range(k):
+                t[i] = fp_sub(0, fp_add(fp_mul(lam[j, s, i], xP, p), c[j, s, i], p), p)
+            t[0] = fp_add(t[0], (1 - v)*yP + v*xP, p)
+            fp12_mul(num, t, modulus, p, prod, num)
+            # t = (1 - v)*(xP - x_den) + v
+            for i in range(k):
+                t[i] = fp_sub(0, (1 - v)*x_den[j, s, i], p)
+            t[0] = fp_add(t[0], (1 - v)*xP + v, p)
+            fp12_mul(den, t, modulus, p, prod, den)
+
+
+def fixed_miller_loop(double, vertical, lam, c, x_den, modulus, p):
+    """
+    miller_loop_small specialized to one fixed set of lines, for a single
+    pair. Numba freezes the closed-over arrays into the compiled function
+    as constants, so only P and the outputs are passed at each call.
+    """
+    def loop(xPs, yPs, num, den):
+        miller_loop_small(xPs, yPs, double, vertical, lam, c, x_den, modulus, p, num, den)
+
+    if njit is not None:
+        loop = njit(nogil=True)(loop)
+    return loop
+
+
+if njit is not None:
+    fp_add = njit(cache=True, nogil=True)(fp_add)
+    fp_sub = njit(cache=True, nogil=True)(fp_sub)
+    fp_mul = njit(cache=True, nogil=True)(fp_mul)
+    poly_mul = njit(cache=True, nogil=True)(poly_mul)
+    poly_mul_karatsuba = njit(cache=True, nogil=True)(poly_mul_karatsuba)
+    fp12_mul = njit(cache=True, nogil=True)(fp12_mul)
+    miller_loop_small = njit(cache=True, nogil=True)(miller_loop_small)
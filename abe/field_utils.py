@@ -0,0 +1,25 @@
+#
+# Arithmetic helpers that work over any field
+#
+
+def batch_invert(values):
+    """
+    Invert all the non-zero `values` with a single field inversion
+    (Montgomery's trick). Zero entries are returned as they are.
+    """
+    result = list(values)
+    nonzero = [i for (i, v) in enumerate(values) if v != 0]
+    if not nonzero:
+        return result
+
+    prefix = [values[nonzero[0]]]
+    for i in nonzero[1:]:
+        prefix.append(prefix[-1]*values[i])
+
+    inv = 1/prefix[-1]
+    for k in range(len(nonzero) - 1, 0, -1):
+        i = nonzero[k]
+        result[i] = inv*prefix[k-1]
+        inv = inv*values[i]
+    result[nonzero[0]] = inv
+    return result
@@ -1,12 +1,183 @@
 #
 # tools for working with the lagrange basis
 #
+import functools
 from sage.rings.polynomial.all import PolynomialRing
+from abe.field_utils import batch_invert
+from abe.fast_fp import np, njit, _JIT_PRIME_BOUND
+
+
+def _is_prime_field(field):
+    return field.characteristic() == field.order()
+
+
+def _denominators_mod_p(xes, p, out):
+    """
+    out[i] = prod_{j != i} (x_i - x_j) mod p
+    """
+    n = len(xes)
+    for i in range(n):
+        d = 1
+        for j in range(n):
+            if j != i:
+                d = (d * (xes[i] - xes[j])) % p
+        out[i] = d
+
+
+def _eval_mod_p(xes, weights, v, p, out):
+    """
+    out[i] = w_i * prod_{j != i} (v - x_j) mod p, using prefix and suffix
+    products of (v - x_j) so that no inversion is needed.
+    """
+    n = len(xes)
+    acc = 1
+    for i in range(n):
+        out[i] = acc
+        acc = (acc * (v - xes[i])) % p
+    acc = 1
+    for i in range(n-1, -1, -1):
+        out[i] = (((out[i] * acc) % p) * weights[i]) % p
+        acc = (acc * (v - xes[i])) % p
+
+
+if njit is not None:
+    _denominators_mod_p_jit = njit(cache=True)(_denominators_mod_p)
+    _eval_mod_p_jit = njit(cache=True)(_eval_mod_p)
+
+
+def _lagrange_denominators_small_prime(p, xes_int):
+    n = len(xes_int)
+    if njit is not None and p < _JIT_PRIME_BOUND:
+        out = np.empty(n, dtype=np.int64)
+        _denominators_mod_p_jit(np.array(xes_int, dtype=np.int64), p, out)
+        return [int(d) for d in out]
+    out = [0]*n
+    _denominators_mod_p(xes_int, p, out)
+    return out
+
+
+def _lagrange_eval_small_prime(p, xes_int, weights_int, v_int):
+    n = len(xes_int)
+    if njit is not None and p < _JIT_PRIME_BOUND:
+        out = np.empty(n, dtype=np.int64)
+        _eval_mod_p_jit(
+            np.array(xes_int, dtype=np.int64),
+            np.array(weights_int, dtype=np.int64),
+            v_int, p, out
+        )
+        return [int(val) for val in out]
+    out = [0]*n
+    _eval_mod_p(xes_int, weights_int, v_int, p, out)
+    return out
+
+def _master_coefficients(xes_f, one):
+    """
+    Coefficients (lowest degree first) of M(H) = prod (H - x_j).
+    """
+    coefs = [one]
+    for xj in xes_f:
+        shifted = [0*one] + coefs
+        for k in range(len(coefs)):
+            shifted[k] = shifted[k] - xj*coefs[k]
+        coefs = shifted
+    return coefs
+
+
+def _denominators(field, xes, xes_f):
+    """
+    Returns d_i = prod_{j != i} (x_i - x_j) for every i. When the points
+    are 0, 1, ..., n-1 this has the closed form
+    (-1)^(n-1-i) * i! * (n-1-i)!.
+    """
+    n = len(xes_f)
+
+    if list(xes) == list(range(n)):
+        factorials = [field(1)]
+        for k in range(1, n):
+            factorials.append(factorials[-1]*k)
+        return [
+            (-1)**(n-1-i) * factorials[i] * factorials[n-1-i]
+            for i in range(n)
+        ]
+
+    if _is_prime_field(field):
+        p = int(field.order())
+        xes_int = [int(x) for x in xes_f]
+        return [field(d) for d in _lagrange_denominators_small_prime(p, xes_int)]
+
+    denominators = []
+    for i in range(n):
+        d = field(1)
+        for j in range(n):
+            if j == i: continue
+            d = d * (xes_f[i] - xes_f[j])
+        denominators.append(d)
+    return denominators
+
+
+@functools.lru_cache(maxsize=32)
+def lagrange_weights(field, xes):
+    """
+    Barycentric weights w_i = 1 / prod_{j != i} (x_i - x_j) for the
+    points `xes`, which must be a tuple so that the weights can be
+    cached across calls.
+    """
+    xes_f = [field(x) for x in xes]
+    return tuple(batch_invert(_denominators(field, xes, xes_f)))
+
+
+def lagrange_eval_all(field, xes, v):
+    """
+    Evaluates every Lagrange basis polynomial for the points `xes` at
+    `v` using the barycentric form
+
+        L_i(v) = (w_i / (v - x_i)) / sum_j (w_j / (v - x_j))
+
+    Once the weights of `xes` are cached this is O(n) per call.
+    """
+    xes = tuple(xes)
+    weights = lagrange_weights(field, xes)
+    v = field(v)
+    basis = dict()
+
+    if _is_prime_field(field):
+        # Prime fields run on plain integers, and on Numba when the
+        # residues fit in a machine word
+        p = int(field.order())
+        values = _lagrange_eval_small_prime(
+            p,
+            [int(field(x)) for x in xes],
+            [int(w) for w in weights],
+            int(v)
+        )
+        for (x, val) in zip(xes, values):
+            basis[x] = field(val)
+        return basis
+    diffs = []
+
+    for x in xes:
+        diff = v - field(x)
+        if diff == 0:
+            for y in xes:
+                basis[y] = field(1) if y == x else field(0)
+            return basis
+        diffs.append(diff)
+
+    # All the 1/(v - x_i) and 1/total share two field inversions
+    terms = [w*inv for (w, inv) in zip(weights, batch_invert(diffs))]
+    inv_total = 1/sum(terms)
+    for (x, t) in zip(xes, terms):
+        basis[x] = t*inv_total
+
+    return basis
+
 
 def lagrange_basis(field, xes, eval_at = None):
     """
     Given a set of evaluation points `xes`, computes the lagarange basis
-    using those points.
+    using those points. Results are memoized on (field, set of xes,
+    eval_at), so protocols that interpolate over the same points in
+    every round, in whatever order, only pay for the first call.
 
     :param FiniteField field: Base field of the polynomial
 
@@ -17,23 +188,51 @@ def lagrange_basis(field, xes, eval_at = None):
         polynomial basis. On the other hand, if eval_at is non-Null, it
         evaluates the different bases at that point.
     """
-    if eval_at is None:
-        R = PolynomialRing(field, "H")
-        H = R.gen()
-    else:
-        H = field(eval_at)
+    xes = tuple(xes)
+    xs = frozenset(xes)
+    if len(xs) != len(xes):
+        raise ValueError("Lagrange basis of repeated x coordinates")
+    return dict(_lagrange_basis_cached(field, xs, eval_at))
+
+
+@functools.lru_cache(maxsize=64)
+def _lagrange_basis_cached(field, xs, eval_at):
+    """
+    Memoized lagrange basis of the set of points `xs`, returned as a
+    tuple of (x, basis) pairs so that the cached value cannot be mutated
+    by callers.
+    """
+    basis = _lagrange_basis(field, tuple(xs), eval_at)
+    return tuple(basis.items())
 
+
+def _lagrange_basis(field, xes, eval_at = None):
+    """
+    Uncached lagrange basis. The master polynomial M(H) = prod (H - x_j)
+    is computed once, and each basis polynomial is then
+    M(H) / (H - x_i) / d_i, where the division by the linear factor is a
+    synthetic division.
+    """
+    if eval_at is not None:
+        return lagrange_eval_all(field, xes, eval_at)
+
+    n = len(xes)
+    xes_f = [field(x) for x in xes]
+    inv_denominators = batch_invert(_denominators(field, xes, xes_f))
     basis = dict()
 
-    for i in range(len(xes)):
-        val = 1
-        for j in range(len(xes)):
-            if j == i: continue
+    R = PolynomialRing(field, "H")
+    master = _master_coefficients(xes_f, field(1))
 
-            factor = (H - field(xes[j]))/field(xes[i] - xes[j])
-            val = val * factor
+    for i in range(n):
+        # Synthetic division of M(H) by (H - x_i)
+        quotient = [field(0)]*n
+        quotient[n-1] = master[n]
+        for k in range(n-2, -1, -1):
+            quotient[k] = master[k+1] + xes_f[i]*quotient[k+1]
 
-        basis[xes[i]] = val
+        inv_d = inv_denominators[i]
+        basis[xes[i]] = R([q*inv_d for q in quotient])
 
     return basis
 
@@ -49,12 +248,15 @@ if __name__ == '__main__':
 
         fx = Y**3+ 13*(Y**2) + 11*Y + 4
 
+        drawn_ints = set()
         roots = dict()
 
         for i in range(100):
-            x = Fp.random_element()
-            while x in roots:
-                x = Fp.random_element()
+            xi = int(Fp.random_element())
+            while xi in drawn_ints or xi == 0:
+                xi = int(Fp.random_element())
+            drawn_ints.add(xi)
+            x = Fp(xi)
             roots[x] = fx(x)
 
         basis = lagrange_basis(Fp, list(roots.keys()))
@@ -72,12 +274,15 @@ if __name__ == '__main__':
 
         fx = Y**3+ 13*(Y**2) + 11*Y + 4
 
+        drawn_ints = set()
         roots = dict()
 
         for i in range(50):
-            x = Fp.random_element()
-            while x in roots:
-                x = Fp.random_element()
+            xi = int(Fp.random_element())
+            while xi in drawn_ints or xi == 0:
+                xi = int(Fp.random_element())
+            drawn_ints.add(xi)
+            x = Fp(xi)
             roots[x] = fx(x)
 
         basis = lagrange_basis(Fp, list(roots.keys()), 0)
@@ -88,5 +293,10 @@ if __name__ == '__main__':
 
         assert result == fx(0)
 
+        # The cache is keyed on the set of points, not their order
+        hits = _lagrange_basis_cached.cache_info().hits
+        assert lagrange_basis(Fp, list(reversed(roots.keys())), 0) == basis
+        assert _lagrange_basis_cached.cache_info().hits == hits + 1
+
     test_basis_gen()
     test_value_gen()
\ No newline at end of file
@@ -8,6 +8,8 @@ import sage.logic.propcalc as prop
 import sage.logic.logicparser as lp
 from sage.rings.all import *
 from enum import Enum
+import functools
+import re
 from sage.matrix.constructor import Matrix
 from typing import Callable, Any
 
@@ -22,13 +24,46 @@ class TravOrder(Enum):
     Preorder = 2
     Postorder = 3
 
+def _freeze(tree):
+    """
+    Turn Sage's nested-list parse tree into nested tuples
+    """
+    if isinstance(tree, list):
+        return tuple(_freeze(e) for e in tree)
+    return tree
+
+@functools.lru_cache(maxsize=256)
+def _parse_formula_cached(formula_string: str, is_monotone: bool):
+    """
+    Parse (and, unless monotone, convert to CNF) a formula string. The
+    resulting parse tree is returned as immutable nested tuples so that
+    it can be shared between calls.
+    """
+    formula = prop.formula(formula_string)
+    # Monotone formulas have no negations, so there is nothing to convert
+    # to CNF nor any negation to distribute
+    if is_monotone:
+        return _freeze(formula.tree())
+
+    formula.convert_cnf()
+    tree = formula.tree()
+    tree = lp.apply_func(tree, formula.dist_not)
+    return _freeze(tree)
+
+# Negation tokens of a formula string, checked before parsing it as monotone
+_NEGATION_TOKEN = re.compile(r"~|!|\bnot\b")
+
 class Formula:
+    __slots__ = ('_ty', '_name', '_left', '_right', '_parent', '_root_cache',
+                 '_span', '_content', '_label')
+
     def __init__(self, ty : NodeType, name: str, left = None, right = None ) -> None:
         self._ty = ty
         self._name = name
         self._left = left
         self._right = right
         self._parent = None
+        self._root_cache = self
         self._span = None
         self._content = None
         self._label = None
@@ -40,8 +75,8 @@ class Formula:
         self._label = label
 
     def unique_name(self):
-        label = self.label()
-        name = self.name()
+        label = self._label
+        name = self._name
         return f"{name}-{label}" if label else name
 
     def content(self):
@@ -53,17 +88,46 @@ class Formula:
         return old_content
 
     def root(self):
-        if self.parent() == None:
-            return self
-        else:
-            return self.parent().root()
+        """
+        Return the root of the tree. The root found is memoized on every
+        node of the path walked (path compression), and a memoized root
+        that has since gained a parent is walked up again.
+        """
+        r = self._root_cache
+        if r is not None and r._parent is None:
+            return r
+
+        path = []
+        r = self
+        while r._parent is not None:
+            path.append(r)
+            cached = r._root_cache
+            if cached is not None and cached is not r and cached._parent is None:
+                r = cached
+                break
+            r = r._parent
+
+        for node in path:
+            node._root_cache = r
+        return r
 
     def parent(self):
         return self._parent
 
     def set_parent(self, parent):
+        """
+        Attach this node under `parent`. The memoized roots of the whole
+        subtree that moves are dropped, as they may name the old root.
+        """
         old_parent = self._parent
         self._parent = parent
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node._root_cache = None
+            for child in (node._left, node._right):
+                if isinstance(child, Formula):
+                    stack.append(child)
         return old_parent
 
     def span(self):
@@ -72,6 +136,47 @@ class Formula:
     def set_span(self, val):
         self._span = val
 
+    def assign_spans(self):
+        """
+        Assign the monotone span program rows (Lewko-Waters) to the
+        literals of the tree and return the number of columns. Rather than
+        copying a growing vector into every gate, each node carries its
+        vector as a chain of (column, value) entries: an Or gate passes
+        its chain to both children, an And gate allocates the next column
+        c and passes (c, 1) on top of its chain to the left child and a
+        fresh (c, -1) to the right child. Every literal row is allocated
+        once, at full width, when its chain is written out.
+        """
+        chains = []
+        columns = 1
+        stack = [(self, (0, 1, None))]
+        while stack:
+            (node, chain) = stack.pop()
+            ty = node._ty
+            if ty == NodeType.Literal:
+                if node._negated:
+                    raise ValueError("Attempt to span for negated literal")
+                chains.append((node, chain))
+            elif ty == NodeType.Or:
+                stack.append((node._right, chain))
+                stack.append((node._left, chain))
+            elif ty == NodeType.And:
+                col = columns
+                columns = columns + 1
+                stack.append((node._right, (col, -1, None)))
+                stack.append((node._left, (col, 1, chain)))
+            else:
+                raise ValueError("Attempt to span for not gate")
+
+        for (literal, chain) in chains:
+            row = [0]*columns
+            while chain is not None:
+                (col, val, chain) = chain
+                row[col] = val
+            literal.set_span(row)
+
+        return columns
+
     def ty(self):
         return self._ty
 
@@ -85,76 +190,95 @@ class Formula:
         return self._name
 
     def literals(self):
-        if self.ty() == NodeType.Literal:
-            return [self]
-        elif self.ty() == NodeType.Not:
-            return self.left().literals()
-        else:
-            lefts = self.left().literals()
-            rights = self.right().literals()
-            lefts.extend(rights)
-            return lefts
+        """
+        Return the literals of the tree from left to right
+        """
+        out = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            ty = node._ty
+            if ty == NodeType.Literal:
+                out.append(node)
+            elif ty == NodeType.Not:
+                stack.append(node._left)
+            else:
+                stack.append(node._right)
+                stack.append(node._left)
+        return out
 
     def sibling(self):
-        parent = self.parent()
+        parent = self._parent
         if parent is None:
             return None
-        l = parent.left()
-        r = parent.right()
-        if l == self:
+        l = parent._left
+        r = parent._right
+        if l is self:
             return r
-        elif r == self:
+        elif r is self:
             return l
         else:
             assert False, "Bug in code"
 
     def traverse(self, func : Callable[[Any], Any], order: TravOrder = TravOrder.Inorder, ):
         """
-        Return the tree as a traversal list
+        Call `func` on every node of the tree in the given order. The tree
+        is walked with an explicit stack: a gate is pushed back as
+        expanded together with its children, and `func` is called on it
+        when it is popped the second time.
         """
 
-        if func == None:
+        if func is None:
             raise ValueError("Traverse must have a non-None callable")
 
-        if self.ty == NodeType.Literal:
-            func(self)
-            return
-
-        if order == TravOrder.Preorder:
-            self.left().list_traverse(func,order)
-            func(self)
-            self.right().list_traverse(func, order)
-        elif order == TravOrder.Inorder:
-            func(self)
-            self.left().list_traverse(func, order)
-            self.right().list_traverse(func, order)
-        elif order == TravOrder.Postorder:
-            self.left().list_traverse(func, order)
-            self.right().list_traverse(func, order)
-            func(self)
-        else:
+        if order not in (TravOrder.Preorder, TravOrder.Inorder, TravOrder.Postorder):
             raise ValueError("Unknown traversal order")
 
+        stack = [(self, False)]
+        while stack:
+            (node, expanded) = stack.pop()
+            if expanded or node._ty == NodeType.Literal:
+                func(node)
+                continue
+
+            left = node._left
+            right = node._right
+            if order == TravOrder.Preorder:
+                if right is not None:
+                    stack.append((right, False))
+                stack.append((left, False))
+                stack.append((node, True))
+            elif order == TravOrder.Inorder:
+                if right is not None:
+                    stack.append((right, False))
+                stack.append((node, True))
+                stack.append((left, False))
+            else:
+                stack.append((node, True))
+                if right is not None:
+                    stack.append((right, False))
+                stack.append((left, False))
+
     @staticmethod
     def relabel_duplicates(root_node):
         labels = root_node.literals()
-        uniques = map(lambda x : x.name(), labels)
-        indexes = dict(map(lambda x : (x, 0), uniques))
+        indexes = dict()
 
         for x in labels:
             assert isinstance(x, (LiteralNode))
-            index = indexes[x.name()]
-            indexes[x.name()] = index + 1
-            x.set_label(index)
+            name = x._name
+            index = indexes.get(name, 0)
+            indexes[name] = index + 1
+            x._label = index
 
 
     @staticmethod
     def from_formula(formula_string: str, is_monotone=False):
-        formula = prop.formula(formula_string)
-        if not is_monotone:
-            formula.convert_cnf()
-        tree = formula.tree()
-        tree = lp.apply_func(tree, formula.dist_not)
+        if is_monotone and _NEGATION_TOKEN.search(formula_string):
+            raise ValueError("Input formula is not monotone")
+
+        # The parse is memoized; the mutable tree is rebuilt on every call
+        tree = _parse_formula_cached(formula_string, bool(is_monotone))
         formula = Formula.from_list(tree, is_monotone)
 
         if is_monotone:
@@ -165,47 +289,75 @@ class Formula:
 
     @staticmethod
     def from_list(lst, is_monotone):
-        if len(lst) == 3:
-            if lst[0] == '&' and lst[1] == lst[2]:
-                return LiteralNode(lst[1])
-            elif lst[0] == '~' or lst[0] == '!'  or lst[0] == 'not':
-                if is_monotone:
-                    raise ValueError("Input formula is not monotone")
-                if lst[1] == None and lst[2] == None:
-                    raise ValueError("Negation of non-existent literal")
-                entry = lst[1] or lst[2]
-                rest = Formula.from_list(entry, is_monotone)
-                node = NotNode(rest)
-                rest.set_parent(node)
-                return node
-
-            elif lst[0] == '&' or lst[0] == 'and':
-                if lst[1] == None or lst[2] == None:
-                    raise ValueError("And of non-existent literal")
-
-                left = Formula.from_list(lst[1], is_monotone)
-                right = Formula.from_list(lst[2], is_monotone)
-                node = AndNode(left, right)
-                left.set_parent(node)
-                right.set_parent(node)
-                return node
-
-            elif lst[0] == '|'  or lst[0] == 'or':
-                if lst[1] == None or lst[2] == None:
-                    raise ValueError("Or of non-existent literal")
-                left = Formula.from_list(lst[1], is_monotone)
-                right = Formula.from_list(lst[2], is_monotone)
-                node = OrNode(left, right)
-                left.set_parent(node)
-                right.set_parent(node)
-                return node
-
-        elif len(lst) == 1:
-            return LiteralNode(lst[0])
-        else:
-            raise ValueError("Invalid input formula")
+        """
+        Build the formula tree from Sage's parse tree. The parse tree is
+        walked in post-order with an explicit stack: the first visit of
+        a gate pushes its children, the second visit combines their
+        nodes. Parent pointers are set in one sweep at the end.
+        """
+        results = []
+        stack = [(lst, False)]
+
+        while stack:
+            (entry, expanded) = stack.pop()
+
+            if expanded:
+                op = entry[0]
+                if op in _NEGATIONS:
+                    # Negations sit on literals once distributed, so they
+                    # are kept as the literal's polarity
+                    child = results.pop()
+                    if child._ty == NodeType.Literal:
+                        child._negated = not child._negated
+                        results.append(child)
+                    else:
+                        results.append(NotNode(child))
+                else:
+                    right = results.pop()
+                    left = results.pop()
+                    results.append(_BINARY_GATES[op](left, right))
+                continue
+
+            if len(entry) == 3:
+                op = entry[0]
+                if op == '&' and entry[1] == entry[2]:
+                    results.append(LiteralNode(entry[1]))
+                elif op in _NEGATIONS:
+                    if is_monotone:
+                        raise ValueError("Input formula is not monotone")
+                    if entry[1] is None and entry[2] is None:
+                        raise ValueError("Negation of non-existent literal")
+                    stack.append((entry, True))
+                    stack.append((entry[1] or entry[2], False))
+                elif op in _BINARY_GATES:
+                    if entry[1] is None or entry[2] is None:
+                        gate = "And" if _BINARY_GATES[op] is AndNode else "Or"
+                        raise ValueError(f"{gate} of non-existent literal")
+                    stack.append((entry, True))
+                    stack.append((entry[2], False))
+                    stack.append((entry[1], False))
+                else:
+                    raise ValueError("Invalid input formula")
+            elif len(entry) == 1:
+                results.append(LiteralNode(entry[0]))
+            else:
+                raise ValueError("Invalid input formula")
+
+        root = results.pop()
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for child in (node._left, node._right):
+                if child is not None:
+                    child._parent = node
+                    child._root_cache = root
+                    stack.append(child)
+
+        return root
 
 class AndNode(Formula):
+    __slots__ = ()
+
     def __init__(self, left, right) -> None:
         super().__init__(NodeType.And, "&", left, right);
 
@@ -224,16 +376,9 @@ class AndNode(Formula):
 
         return f"{left} & {right}"
 
-    def set_span(self, val):
-        super().set_span(val)
-        left = list(val)
-        right = [0]*len(val)
-        left.append(1)
-        right.append(-1)
-        self._left.set_span(left)
-        self._right.set_span(right)
-
 class OrNode(Formula):
+    __slots__ = ()
+
     def __init__(self, left, right) -> None:
         super().__init__(NodeType.Or, "|", left, right);
 
@@ -252,12 +397,9 @@ class OrNode(Formula):
 
         return f"{left} | {right}"
 
-    def set_span(self, val):
-        super().set_span(val)
-        self._left.set_span(val)
-        self._right.set_span(val)
-
 class NotNode(Formula):
+    __slots__ = ()
+
     def __init__(self, value) -> None:
         super().__init__(NodeType.Not, "~", value, None);
 
@@ -274,46 +416,59 @@ class NotNode(Formula):
         raise ValueError("Attempt to span for not gate")
 
 class LiteralNode(Formula):
+    __slots__ = ('_negated',)
     RESERVED = ['&', 'and', '|' , "or", "not" , "~"]
 
-    def __init__(self, name: str) -> None:
+    def __init__(self, name: str, negated: bool = False) -> None:
         if name in LiteralNode.RESERVED:
             raise ValueError(f"Invalid name of literal: {name}")
         super().__init__(NodeType.Literal, name, None, None)
         self._label = 0
+        self._negated = negated
+
+    def negated(self):
+        return self._negated
 
     def __repr__(self) -> str:
+        sign = "~" if self._negated else ""
         if self.span():
-            return f"{self.unique_name()}/{self.span()}"
+            return f"{sign}{self.unique_name()}/{self.span()}"
         else:
-            return f"{self.unique_name()}"
+            return f"{sign}{self.unique_name()}"
+
+
+_NEGATIONS = ('~', '!', 'not')
+_BINARY_GATES = {
+    '&' : AndNode,
+    'and' : AndNode,
+    '|' : OrNode,
+    'or' : OrNode,
+}
 
 
 class MSP:
     def __init__(self, formula: str, ring = ZZ):
         node = Formula.from_formula(formula, True)
+        columns = node.assign_spans()
         attribues = node.literals()
-        max_column = 0
-        matrix_rows = list()
-        pi = dict()
+        entries = list()
+        pi = [None]*len(attribues)
+        pi_inv = dict()
         row_count = 0
 
         for a in attribues:
-            if len(a.span()) > max_column:
-                max_column = len(a.span())
-
-        for a in attribues:
-            delta = max_column - len(a.span())
-            span = list(a.span())
-            if delta > 0:
-                span.extend([0]*delta)
-            matrix_rows.append(span)
-            pi[a.unique_name()] = row_count
+            entries.extend(a._span)
+            name = a.unique_name()
+            pi[row_count] = name
+            pi_inv[name] = row_count
             row_count = row_count + 1
 
         self._node = node
-        self._pi_inv = pi
-        self._matrix = Matrix(ring, matrix_rows)
+        self._pi = pi
+        self._pi_inv = pi_inv
+        # One flat row-major buffer with explicit dimensions, coerced by
+        # Sage in a single call
+        self._matrix = Matrix(ring, row_count, columns, entries)
 
     def matrix(self):
         return self._matrix
@@ -322,10 +477,9 @@ class MSP:
         return self._node
 
     def pi(self, index):
-        for (lit,val) in enumerate(self._pi_inv):
-            if val == index:
-                return lit
-        raise ValueError("Index not found")
+        if not 0 <= index < len(self._pi):
+            raise ValueError("Index not found")
+        return self._pi[index]
 
     def pi_inverse(self, literal):
         return self._pi_inv[literal]
@@ -355,4 +509,16 @@ if __name__ == '__main__':
         mat = MSP(g, GF(17))
         print(mat.matrix())
 
+        # Moving a subtree must not leave stale roots on its descendants
+        (a, b, c) = (LiteralNode("a"), LiteralNode("b"), LiteralNode("c"))
+        sub = AndNode(a, b)
+        a.set_parent(sub)
+        b.set_parent(sub)
+        top = OrNode(sub, c)
+        sub.set_parent(top)
+        c.set_parent(top)
+        assert a.root() is top
+        sub.set_parent(None)
+        assert a.root() is sub and b.root() is sub
+
     main()
\ No newline at end of file
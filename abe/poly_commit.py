@@ -2,11 +2,84 @@
 # Computes different polynomial commitments
 #
 
-from abe import BNCurve
+from abe import BNCurve, build_comb, comb_mul, wnaf, wnaf_mul
 from sage.rings.all import *;
 from sage.schemes.all import *;
+from abe.fast_fp import np, njit, _JIT_PRIME_BOUND
 from hashlib import sha256
 
+
+def _synthetic_division_mod_p(coefs, a, p, quotient):
+    """
+    Divide the polynomial with coefficients `coefs` (lowest degree first)
+    by (X - a) modulo p. The quotient coefficients are written to
+    `quotient` and the remainder, i.e., the value at a, is returned.
+    """
+    acc = 0
+    for i in range(len(coefs) - 1, 0, -1):
+        acc = (coefs[i] + a*acc) % p
+        quotient[i - 1] = acc
+    if len(coefs) > 0:
+        acc = (coefs[0] + a*acc) % p
+    return acc
+
+
+if njit is not None:
+    _synthetic_division_mod_p_jit = njit(cache=True)(_synthetic_division_mod_p)
+
+
+def _synthetic_division_prime(p, coefs_int, a_int):
+    n = max(len(coefs_int) - 1, 0)
+    if njit is not None and p < _JIT_PRIME_BOUND:
+        quotient = np.zeros(n, dtype=np.int64)
+        val = _synthetic_division_mod_p_jit(
+            np.array(coefs_int, dtype=np.int64), a_int, p, quotient
+        )
+        return ([int(b) for b in quotient], int(val))
+    quotient = [0]*n
+    val = _synthetic_division_mod_p(coefs_int, a_int, p, quotient)
+    return (quotient, val)
+
+
+def pippenger_msm(points, scalars, identity):
+    """
+    Multi-scalar multiplication sum(s_i * P_i) with Pippenger's bucket
+    method. The scalars are split into windows of c ~ log2(N) bits; in
+    each window every point is added to the bucket of its digit, and
+    the buckets are combined as sum(b * S_b) with a running sum.
+    """
+    scalars = [int(s) for s in scalars]
+    if not points:
+        return identity
+
+    c = max(1, len(points).bit_length() - 1)
+    mask = (1 << c) - 1
+    bits = max(s.bit_length() for s in scalars)
+    windows = (bits + c - 1) // c
+
+    result = identity
+    for w in range(windows - 1, -1, -1):
+        for _ in range(c):
+            result = result + result
+
+        buckets = [None]*(mask + 1)
+        shift = w*c
+        for (P, s) in zip(points, scalars):
+            b = (s >> shift) & mask
+            if b:
+                buckets[b] = P if buckets[b] is None else buckets[b] + P
+
+        running = identity
+        total = identity
+        for b in range(mask, 0, -1):
+            if buckets[b] is not None:
+                running = running + buckets[b]
+            total = total + running
+        result = result + total
+
+    return result
+
+
 class PolyCommit:
     def __init__(self):
         """
@@ -39,26 +112,37 @@ class CoefficientCommitment(PolyCommit):
     """
     Commit to the coefficient of the polynomial directly
     """
+    # Window width of the comb table of the group generator
+    COMB_BITS = 5
+    # Width of the NAF of the evaluation point in verify
+    WNAF_BITS = 4
+
     def __init__(self, group : BNCurve, poly : PolynomialRing):
         super().__init__()
         self._curve = group
         self._poly = poly
+        self._F = group.scalar_field()
+        (x,y,z) = group.g0()
+        self._g = group.curve()([x,y,z])
+        # Point at infinity
+        self._inf = group.curve()([0,1,0])
+        F = self._F
+        self._coefs = [F(c) for c in poly.list()]
+        bits = F.order().nbits()
+        self._g_comb = build_comb(self._g, bits, CoefficientCommitment.COMB_BITS)
 
     def poly(self):
         return self._poly
 
     def group_gen(self):
-        (x,y,z) = self._curve.g0()
-        return self._curve.curve()([x,y,z])
+        return self._g
 
     def scalar_field(self):
-        return self._curve.scalar_field()
+        return self._F
 
     def commit_poly(self):
-        coefs = list(self.poly())
-        g = self.group_gen()
-        F = self.scalar_field()
-        return [F(i)*g for i in coefs]
+        identity = self._inf
+        return [comb_mul(self._g_comb, int(c), identity) for c in self._coefs]
 
     def eval_with_proof(self, x_val : FiniteField):
         val = self.poly()(x_val)
@@ -66,17 +150,18 @@ class CoefficientCommitment(PolyCommit):
         return val
 
     def verify(self, commitment, x_val, y_val, proof):
-        g = self.group_gen()
         F = self.scalar_field()
         x = F(x_val)
+        identity = self._inf
         # This is the value of g^(p(x))
-        found = F(y_val)*g
-        # Point at infinity
-        expected = self._curve.curve()([0,1,0]);
+        found = comb_mul(self._g_comb, int(F(y_val)), identity)
 
-        for (i,c) in enumerate(commitment):
-            factor =  (x**i)*c
-            expected = expected + factor
+        # Horner's rule on the commitments: the NAF of x is computed once
+        # and shared by all the x*acc multiplications
+        naf = wnaf(int(x), CoefficientCommitment.WNAF_BITS)
+        expected = identity
+        for c in reversed(commitment):
+            expected = wnaf_mul(expected, naf, identity) + c
 
         # expected is the value calculated from commited coefficients
 
@@ -97,16 +182,37 @@ class KZGCommit(PolyCommit):
     """
     Generate KZG commitment using M CRS coefficient
     """
+    # Window width of the comb tables used to build the CRS
+    COMB_BITS = 5
+
     def __init__(self, group : BNCurve, M: int, poly : PolynomialRing):
         super().__init__()
         self._curve = group
         self._poly = poly
-        trapdoor = group.scalar_field().random_element()
+        self._F = group.scalar_field()
+        F = self._F
+        self._coefs = [F(c) for c in poly.list()]
+        self._coefs_int = [int(c) for c in self._coefs]
+        trapdoor = F.random_element()
         g0 = self._curve.g0()
         g1 = self._curve.g1()
-        powers = [(trapdoor**i) for i in range(M)]
-        self._crs_0 = [p*g0 for p in powers]
-        self._crs_1 = [p*g1 for p in powers]
+
+        p = F.one()
+        powers = [p]
+        for _ in range(M - 1):
+            p = p*trapdoor
+            powers.append(p)
+
+        bits = F.order().nbits()
+        comb0 = build_comb(g0, bits, KZGCommit.COMB_BITS)
+        comb1 = build_comb(g1, bits, KZGCommit.COMB_BITS)
+        identity0 = 0*g0
+        identity1 = 0*g1
+        self._crs_0 = [comb_mul(comb0, int(p), identity0) for p in powers]
+        self._crs_1 = [comb_mul(comb1, int(p), identity1) for p in powers]
+        # tau^0 entries of the CRS, i.e., the two generators
+        self._g0 = self._crs_0[0]
+        self._g1 = self._crs_1[0]
 
     def crs_0(self):
         return self._crs_0
@@ -118,42 +224,42 @@ class KZGCommit(PolyCommit):
         return self._poly
 
     def scalar_field(self):
-        return self._curve.scalar_field()
+        return self._F
 
     @staticmethod
     def do_commit_on_crs(crs, poly):
-        commitment = None
-        for (i,coef) in enumerate(poly):
-            entry = coef*crs[i]
-            if commitment:
-                commitment = commitment + entry
-            else:
-                commitment = entry
-
-        return commitment
+        coefs = list(poly)
+        if len(coefs) > len(crs):
+            raise ValueError("Polynomial degree exceeds the CRS size")
+        return pippenger_msm(crs[:len(coefs)], coefs, 0*crs[0])
 
 
     def commit_poly(self):
-        return KZGCommit.do_commit_on_crs(self.crs_0(), self.poly())
+        return KZGCommit.do_commit_on_crs(self._crs_0, self._coefs)
 
     def eval_with_proof(self, x_val : FiniteField):
-        X = self.poly().variables()[0]
-        val = self.poly()(x_val)
-        poly_y = (self.poly() - val)
-        factor = (X - x_val)
-        assert (poly_y % factor) == 0, "Bug in code"
-        poly_g = poly_y // factor
-        proof = KZGCommit.do_commit_on_crs(self.crs_0(), poly_g)
-        return (val, proof)
+        # Synthetic division of p(X) by (X - x_val): Horner's rule yields the
+        # quotient coefficients b_i = a_{i+1} + x_val*b_{i+1} and, as the
+        # final remainder, p(x_val). Hence (p(X) - p(x_val))/(X - x_val) is
+        # the quotient, without a generic polynomial division. The scalar
+        # field is prime, so this runs on integers modulo its order.
+        F = self.scalar_field()
+        p = int(F.order())
+        (quotient, val) = _synthetic_division_prime(p, self._coefs_int, int(F(x_val)))
+
+        proof = KZGCommit.do_commit_on_crs(self._crs_0, quotient)
+        return (F(val), proof)
 
     def verify(self, commitment, x_val, y_val, proof):
         # Compute (X-x_val) commitment on G2 group
-        linear_commit = KZGCommit.do_commit_on_crs(self.crs_1(), [-x_val, 1])
-        poly_minus_val = commitment - y_val*self.crs_0()[0]
-        lhs = self._curve.pair(proof, linear_commit)
-        rhs = self._curve.pair(poly_minus_val, self.crs_1()[0])
-
-        return lhs == rhs
+        xv = int(self._F(x_val))
+        linear_commit = self._crs_1[1] + (-xv)*self._g1
+        poly_minus_val = commitment - y_val*self._g0
+        # e(proof, X - x_val) == e(C - y_val, g1) checked as a product of
+        # pairings sharing one final exponentiation
+        acc = self._curve.prod_pair([(proof, linear_commit), (-poly_minus_val, self._g1)])
+
+        return self._curve.gt_is_one(acc)
 
     @staticmethod
     def run_sample_test(curve: BNCurve, poly: PolynomialRing):
@@ -8,13 +8,44 @@ from sage.rings.finite_rings.finite_field_constructor import FiniteFieldFactory
 from sage.rings.finite_rings.finite_field_base import FiniteField as FiniteFieldGeneric;
 from abe import lagrange_basis, Formula, NodeType
 from typing import TypeAlias, Any
+from abe.fast_fp import np, njit, _JIT_PRIME_BOUND, _NUMPY_PRIME_BOUND
+import functools
 
 UserId : TypeAlias = int | bytes
 
+
+def _horner_mod_p(coeffs, xs, p, out):
+    """
+    out[j] = sum(coeffs[i] * xs[j]^i) mod p, by Horner's rule
+    """
+    for j in range(len(xs)):
+        x = xs[j]
+        acc = 0
+        for i in range(len(coeffs) - 1, -1, -1):
+            acc = (acc*x + coeffs[i]) % p
+        out[j] = acc
+
+
+if njit is not None:
+    _horner_mod_p_jit = njit(cache=True)(_horner_mod_p)
+else:
+    _horner_mod_p_jit = None
+
+
+@functools.lru_cache(maxsize=32)
+def _poly_ring(field):
+    """
+    The polynomial ring in X over `field`, built once per field
+    """
+    return PolynomialRing(field, "X")
+
+
 class SecretShare:
     """
     Basic interface to secret sharing scheme
     """
+    __slots__ = ('_universe', '_access_structure')
+
     def __init__(self, universe : set[UserId] | None, access_structure : Any) -> None:
         """
         Intialize (a.k.a setup) a secret sharing scheme for a given
@@ -50,48 +81,36 @@ class ShamirSecretSharing(SecretShare):
     """
     Shamir's t-out-of-n threshold secret sharing scheme
     """
+    __slots__ = ('_field', '_zero', '_secret', '_coeffs', '_poly')
+
+    # Smallest batch of shares evaluated with a subproduct tree
+    MULTIPOINT_MIN = 32
 
     @staticmethod
     def random_field_element(ff : FiniteFieldFactory):
         deg = ff.degree()
-        result = ff(0)
 
         if deg == 1:
-            result = ff.random_element()
-        else :
-            gen = ff.gen()
-            for _ in range(deg):
-                result = result*gen + ff.base_ring().random_element()
-        return result
+            return ff.random_element()
+
+        # Build the element from its coefficient vector in one call
+        base = ff.base_ring()
+        return ff([base.random_element() for _ in range(deg)])
 
     @staticmethod
     def serialize_field_element(ff):
         return ff.to_bytes()
 
     @staticmethod
-    def deserialize_field_element(ff, data : bytes | int):
+    def deserialize_field_element(ff, data : bytes | int | FiniteFieldGeneric):
         if isinstance(data, (bytes,)):
             return ff.from_bytes(data)
+        elif getattr(data, 'parent', None) is not None and data.parent() is ff:
+            # Already a native element of the field
+            return data
         else:
             return ff(data)
 
-    @staticmethod
-    def random_poly(poly_ring : PolynomialRing, degree: int):
-        field = poly_ring.base_ring()
-        x = poly_ring.gen()
-        result = poly_ring(0)
-
-        if degree < 0:
-            raise ValueError("Polynomials must have positive degree")
-
-        if degree == 0:
-            return ShamirSecretSharing.random_field_element(field)
-
-        for _ in range(degree):
-            result = result*x + ShamirSecretSharing.random_field_element(field)
-
-        return result
-
 
     def __init__(self, field_secret : bytes | FiniteFieldGeneric, field : FiniteFieldFactory,  threshold: int) -> None:
         super().__init__(None, threshold)
@@ -100,21 +119,17 @@ class ShamirSecretSharing(SecretShare):
             raise ValueError("No secret sharing with threshold less than 2 possible?")
 
         self._field = field
-        self._degree = field.degree() # Extension field to cover GF(2^l) case
-        self._poly_ring = PolynomialRing(self._field, "X")
+        self._zero = field(0)
 
         if isinstance(field_secret, (bytes)):
             self._secret = field.from_bytes(field_secret)
         else:
             self._secret = field_secret
 
-        r_poly = None
-
-        if threshold == 1:
-            self._poly = self._poly_ring(self._secret)
-        else:
-            r_poly = ShamirSecretSharing.random_poly(self._poly_ring, threshold-2)
-            self._poly = r_poly * self._poly_ring.gen() + self._poly_ring(self._secret)
+        # The random coefficients are only sampled once a share is needed
+        self._coeffs = None
+        # The polynomial itself is only built if asked for
+        self._poly = None
 
     def secret(self):
         return self._secret
@@ -122,16 +137,37 @@ class ShamirSecretSharing(SecretShare):
     def threshold(self):
         return self.access_structure()
 
+    def _coefficients(self):
+        """
+        Coefficients of the sharing polynomial, lowest degree first: the
+        secret followed by threshold-1 random coefficients, sampled on
+        first use.
+        """
+        if self._coeffs is None:
+            field = self._field
+            coeffs = [field(self._secret)]
+            for _ in range(self.threshold() - 1):
+                coeffs.append(ShamirSecretSharing.random_field_element(field))
+            self._coeffs = coeffs
+        return self._coeffs
+
     def poly(self):
+        if self._poly is None:
+            self._poly = _poly_ring(self._field)(self._coefficients())
         return self._poly
 
     def poly_eval(self, value):
-        return self._poly(value)
+        # Horner's rule on the coefficient list
+        x = self._field(value)
+        acc = self._zero
+        for c in reversed(self._coefficients()):
+            acc = acc*x + c
+        return acc
 
     def field(self):
         return self._field
 
-    def create_share(self, identity: UserId) -> bytes:
+    def _x_coordinate(self, identity: UserId):
         x_cord = None
         if isinstance(identity, (bytes)):
             x_cord = self.field().from_bytes(identity)
@@ -141,50 +177,148 @@ class ShamirSecretSharing(SecretShare):
         if x_cord == 0:
             raise ValueError("Nah! Not today Satan")
 
-        return self.poly_eval(x_cord).to_bytes()
+        return x_cord
 
-    def recombine(self, shares: dict[UserId, Any]) -> bytes :
-        unique_shares = list(map(
-            lambda b : ShamirSecretSharing.deserialize_field_element(self.field(), b),
-            set(shares)
-        ))
+    def share_element(self, identity: UserId):
+        """
+        The share of `identity` as a field element. Shares are only
+        serialized by `create_share`.
+        """
+        x_cord = self._x_coordinate(identity)
 
-        if len(unique_shares) < self.threshold():
-            raise ValueError("Insufficient number of shares")
+        acc = self._zero
+        for c in reversed(self._coefficients()):
+            acc = acc*x_cord + c
+        return acc
 
-        bases = lagrange_basis(self.field(), unique_shares, self.field()(0))
+    def create_share(self, identity: UserId) -> bytes:
+        return self.share_element(identity).to_bytes()
 
-        result = self.field()(0)
+    def create_shares(self, identities: list[UserId]) -> dict[UserId, bytes]:
+        """
+        Create the shares of many identities at once. Large batches of
+        shares of a non-constant polynomial are evaluated with a
+        subproduct tree: the polynomial is reduced modulo the product of
+        all (X - x_i), then modulo the products of each half of them, and
+        so on down to the linear factors, whose remainders are the
+        shares. Over prime fields with a word-sized modulus, the shares
+        are instead evaluated with Horner's rule on machine integers: in
+        a Numba kernel when available, or on NumPy arrays for all the
+        x-coordinates at once.
+        """
+        xs = [self._x_coordinate(i) for i in identities]
+        coeffs = self._coefficients()
+        field = self._field
+        p = int(field.order())
+
+        if _horner_mod_p_jit is not None and field.degree() == 1 and p < _JIT_PRIME_BOUND:
+            out = np.empty(len(xs), dtype=np.int64)
+            _horner_mod_p_jit(
+                np.array([int(c) for c in coeffs], dtype=np.int64),
+                np.array([int(x) for x in xs], dtype=np.int64),
+                p, out
+            )
+            values = [field(int(v)) for v in out]
+        elif np is not None and field.degree() == 1 and p < _NUMPY_PRIME_BOUND:
+            xs_arr = np.array([int(x) for x in xs], dtype=np.uint64)
+            acc = np.zeros(len(xs), dtype=np.uint64)
+            for c in reversed(coeffs):
+                acc = (acc*xs_arr + np.uint64(int(c))) % np.uint64(p)
+            values = [field(int(v)) for v in acc]
+        elif len(xs) < ShamirSecretSharing.MULTIPOINT_MIN or len(coeffs) < 2:
+            values = []
+            for x in xs:
+                acc = self._zero
+                for c in reversed(coeffs):
+                    acc = acc*x + c
+                values.append(acc)
+        else:
+            poly = self.poly()
+            X = poly.parent().gen()
+            levels = [[X - x for x in xs]]
+            while len(levels[-1]) > 1:
+                below = levels[-1]
+                above = [below[i]*below[i+1] for i in range(0, len(below) - 1, 2)]
+                if len(below) % 2 == 1:
+                    above.append(below[-1])
+                levels.append(above)
+
+            rems = [poly % levels[-1][0]]
+            for level in reversed(levels[:-1]):
+                rems = [rems[j//2] % node for (j, node) in enumerate(level)]
+            values = [r[0] for r in rems]
+
+        return {i : v.to_bytes() for (i, v) in zip(identities, values)}
+
+    def recombine(self, shares: dict[UserId, Any]) -> bytes :
+        field = self.field()
+        points = dict()
 
-        for k,v in bases.items():
-            s = None
-            try:
-                s = shares[k]
-            except:
-                entry = k.to_bytes()
-                s = shares[entry]
+        for (k, v) in shares.items():
+            x = ShamirSecretSharing.deserialize_field_element(field, k)
+            if x not in points:
+                points[x] = ShamirSecretSharing.deserialize_field_element(field, v)
 
-            if isinstance(s, (bytes)):
-                s = self.field().from_bytes(s)
-            result += s*v
+        return self._recombine_elements(points).to_bytes()
+
+    def _recombine_elements(self, points):
+        """
+        Recombine the secret from a dictionary mapping x-coordinates to
+        shares, both as field elements
+        """
+        if len(points) < self.threshold():
+            raise ValueError("Insufficient number of shares")
 
-        return result.to_bytes()
+        bases = lagrange_basis(self._field, points, self._zero)
+        return sum((y*bases[x] for (x, y) in points.items()), self._zero)
 
     @staticmethod
     def run_test_cases(base_field : FiniteFieldFactory, th : int):
         secret = ShamirSecretSharing.random_field_element(base_field)
         secret = ShamirSecretSharing.serialize_field_element(secret)
         sss = ShamirSecretSharing(secret, base_field, th)
-        shares = dict()
-
-        for _ in range(2*th + 5):
-            index = ShamirSecretSharing.random_field_element(base_field).to_bytes()
-            share = sss.create_share(index)
-            shares[index] = share
+        # Distinct non-zero x-coordinates, which small fields such as
+        # GF(65537) would otherwise repeat or hit zero with
+        indexes = dict()
+        while len(indexes) < 2*th + 5:
+            x = ShamirSecretSharing.random_field_element(base_field)
+            if x != 0:
+                indexes[x.to_bytes()] = None
+        indexes = list(indexes)
+        shares = sss.create_shares(indexes)
+
+        for index in indexes[:3]:
+            assert shares[index] == sss.create_share(index), "Batched shares differ"
 
         rc = sss.recombine(shares=shares)
         assert secret == rc, "Share recombination failed"
 
+class _Shamir2(ShamirSecretSharing):
+    """
+    Shamir's 2-out-of-n sharing, used for the AND gates of
+    Benaloh-Leichter trees. A share of the polynomial secret + r*X is
+    computed directly from the pair (secret, r), and two shares (x1, y1),
+    (x2, y2) recombine to (y1*x2 - y2*x1)/(x2 - x1) without a Lagrange
+    basis.
+    """
+    __slots__ = ()
+
+    def __init__(self, field_secret : bytes | FiniteFieldGeneric, field : FiniteFieldFactory) -> None:
+        super().__init__(field_secret, field, 2)
+
+    def share_element(self, identity: UserId):
+        x_cord = self._x_coordinate(identity)
+        (secret, r) = self._coefficients()
+        return secret + r*x_cord
+
+    def _recombine_elements(self, points):
+        if len(points) != 2:
+            return super()._recombine_elements(points)
+
+        ((x1, y1), (x2, y2)) = points.items()
+        return (y1*x2 - y2*x1)/(x2 - x1)
+
+
 class BenalohLeichterCrypto1988(SecretShare):
     """
     Scheme by Benaloh and Leichter from Crypto 1988
@@ -200,6 +334,8 @@ class BenalohLeichterCrypto1988(SecretShare):
     allow higher treshold gates.
     """
 
+    __slots__ = ('_field', '_leaves', '_gates')
+
     @staticmethod
     def do_secret_share(node : Formula, secret: bytes | FiniteFieldGeneric, index :int, field : FiniteFieldFactory):
         """
@@ -218,35 +354,41 @@ class BenalohLeichterCrypto1988(SecretShare):
         values that are needed, not all labels. (This is a major
         weakness of this scheme as users make lots of mistakes with
         this.)
+
+        The tree is walked with an explicit stack of (node, secret,
+        index) entries, so deep formulas do not hit the recursion limit.
         """
         if index < 1:
             raise ValueError("Node index must be non-zero")
 
-        if node.ty() == NodeType.Not:
-            raise ValueError("Only non-monotone formulae are supported")
+        stack = [(node, secret, index)]
 
-        shares = None
+        while stack:
+            (node, secret, index) = stack.pop()
 
-        if node.ty() == NodeType.And:
-            shares = ShamirSecretSharing(secret, field, 2)
-        else:
-            shares = ShamirSecretSharing(secret, field, 1)
+            if node.ty() == NodeType.Not:
+                raise ValueError("Only non-monotone formulae are supported")
 
-        node.set_content(shares)
-        node.set_label(index)
+            if node.ty() == NodeType.And:
+                shares = _Shamir2(secret, field)
+            else:
+                shares = ShamirSecretSharing(secret, field, 1)
 
-        if node.ty() == NodeType.Literal:
-            return
+            node.set_content(shares)
+            node.set_label(index)
 
-        left_index = 2*index
-        right_index = 2*index + 1
+            if node.ty() == NodeType.Literal:
+                continue
 
-        left_secret = shares.create_share(left_index)
-        right_secret = shares.create_share(right_index)
+            left_index = 2*index
+            right_index = 2*index + 1
 
-        BenalohLeichterCrypto1988.do_secret_share(node.left(), left_secret, left_index, field)
+            # Child secrets stay field elements, the tree never serializes them
+            left_secret = shares.poly_eval(shares._x_coordinate(left_index))
+            right_secret = shares.poly_eval(shares._x_coordinate(right_index))
 
-        BenalohLeichterCrypto1988.do_secret_share(node.right(), right_secret, right_index, field)
+            stack.append((node.right(), right_secret, right_index))
+            stack.append((node.left(), left_secret, left_index))
 
 
     def __init__(self, field_secret : bytes, access_structure: str | Formula, field : FiniteFieldFactory) -> None:
@@ -269,6 +411,7 @@ class BenalohLeichterCrypto1988(SecretShare):
         ))
 
         super().__init__(universe, access_structure)
+        self._field = field
         BenalohLeichterCrypto1988.do_secret_share(
             node=self.access_structure(),
             secret=field_secret,
@@ -276,6 +419,33 @@ class BenalohLeichterCrypto1988(SecretShare):
             field=field
         )
 
+        # The tree is fixed once shared, so recombine reads the labels,
+        # types and Shamir instances from these tables instead of the
+        # node accessors: (name, label, parent) per literal, and per gate
+        # (label, (left label, left x), (right label, right x), is_and,
+        # shamir, parent).
+        self._leaves = [
+            (l.name(), l.label(), l.parent())
+            for l in access_structure.literals()
+        ]
+        self._gates = dict()
+        stack = [access_structure]
+        while stack:
+            node = stack.pop()
+            if node.ty() == NodeType.Literal:
+                continue
+            (left, right) = (node.left(), node.right())
+            self._gates[node] = (
+                node.label(),
+                (left.label(), field(left.label())),
+                (right.label(), field(right.label())),
+                node.ty() == NodeType.And,
+                node.content(),
+                node.parent()
+            )
+            stack.append(left)
+            stack.append(right)
+
     def create_share(self, identity : UserId):
         """
         Given an identity, which should be a literal in the boolean
@@ -319,96 +489,61 @@ class BenalohLeichterCrypto1988(SecretShare):
             corresponding to that label.
 
         """
-        literals = self.access_structure().literals()
+        field = self._field
+        gates = self._gates
         working_set = dict()
-        parents = set()
 
-        for l in literals:
-            if not l.name() in shares:
+        # The recombination works bottom up with a worklist: every gate
+        # counts how many of its children have a key-share available in
+        # the `working_set` ({ label : key-share }). An OR gate becomes
+        # ready with one such child, an AND gate with both. A ready gate
+        # recombines its own key-share, puts it in the `working_set` and
+        # counts it towards its own parent. Each gate is thus visited at
+        # most once; we return when the root recombines, and if the
+        # worklist runs dry before that, the formula is not satisfied by
+        # the given shares.
+        satisfied = dict()
+        ready = []
+
+        def child_available(parent):
+            count = satisfied.get(parent, 0) + 1
+            satisfied[parent] = count
+            if count == (2 if gates[parent][3] else 1):
+                ready.append(parent)
+
+        for (name, label, parent) in self._leaves:
+            if not name in shares:
                 continue
-            share = shares[l.name()]
-            key_share = share.get(l.label())
-
-            if key_share:
-                working_set[l.label()] = (l, key_share)
-                parents.add(l.parent())
-
-        #
-        # The recombine logic works are follows: Given the list of
-        # literals and labels by the caller, we first collect all _the
-        # parents_ of those literals in a set called `parents`. Also, we
-        # keep a dictionary of { label : key-share } KVP called the
-        # `working_set`. The `working-set` is essentially the set of
-        # key-shares of the secret that's available to the algorithm at
-        # any given point.
-        #
-        # Then we traverse through all the `parents` and see if any
-        # parent has it's children in the working set that can help it
-        # create its own key-share. For an OR gate, this mean having at
-        # least one child in the `working_set`; for an AND gate, both
-        # the children must be in the `working_set.`
-        #
-        # If a parent is able to generate it's secret from its children,
-        # it then puts its own parent in the parent list, and puts
-        # itself into the `working_set.` This process continues until we
-        # either reach the root node, in which case we return the
-        # recombined secret, or there's no possibility of recombing
-        # anything (i.e., the formula is unsatisfiable) and we raise an
-        # error.
-        #
-        # The following while loop is doing exactly what's described
-        # above.
-        #
-
-        while True:
-            has_update = False
-
-            for p in parents:
-                left = p.left()
-                right = p.right()
-                left_shamir = working_set.get(left.label())
-                right_shamir = working_set.get(right.label())
-
-                entry = dict()
-                shamir = p.content()
-
-                if p.ty() == NodeType.Or and (left_shamir or right_shamir ):
-                    has_update = True
-                    (node, key_share) = left_shamir if left_shamir else right_shamir
-
-                    entry[node.label()] = key_share
-                    del working_set[node.label()]
-
-                elif p.ty() == NodeType.And and left_shamir and right_shamir:
-                    has_update = True
-                    (left_node, left_key_share) = left_shamir
-                    (right_node, right_key_share) = right_shamir
-                    entry = {
-                        left_node.label() : left_key_share,
-                        right_node.label() : right_key_share
-                    }
-                    del working_set[left_node.label()]
-                    del working_set[right_node.label()]
-                else:
-                    continue
-
-                recombined = shamir.recombine(entry)
-                expected = shamir.secret().to_bytes()
-                assert expected == recombined, f"recombined shares {recombined} don't match expected share {shamir.secret()}"
-
-                grand_parent = p.parent()
-
-                if grand_parent == None:
-                    return recombined
-                else:
-                    working_set[p.label()] = (p, recombined)
-                    parents.add(grand_parent)
-                    parents.remove(p)
-
-
-            if not has_update:
-                # If none of the nodes could be traversed upwards, then the tree is not satisfiable
-                break
+            key_share = shares[name].get(label)
+
+            if key_share is not None:
+                working_set[label] = ShamirSecretSharing.deserialize_field_element(field, key_share)
+                if parent is None:
+                    # The formula is a single literal
+                    return working_set[label].to_bytes()
+                child_available(parent)
+
+        while ready:
+            p = ready.pop()
+            (label, (left_label, left_x), (right_label, right_x), is_and, shamir, grand_parent) = gates[p]
+            left_share = working_set.get(left_label)
+
+            if is_and:
+                entry = {left_x : left_share, right_x : working_set[right_label]}
+            elif left_share is not None:
+                entry = {left_x : left_share}
+            else:
+                entry = {right_x : working_set[right_label]}
+
+            # Shares are recombined as field elements and only the
+            # root secret is serialized
+            recombined = shamir._recombine_elements(entry)
+
+            if grand_parent is None:
+                return recombined.to_bytes()
+
+            working_set[label] = recombined
+            child_available(grand_parent)
 
         raise ValueError("This secret share is not satisfiable")
 
@@ -432,7 +567,8 @@ class BenalohLeichterCrypto1988(SecretShare):
 
         try:
             recon = bl.recombine(shares)
-        except:
+        except ValueError:
+            # Unsatisfiable set of shares
             pass
 
         return secret == recon
@@ -444,6 +580,9 @@ if __name__ == '__main__':
         ShamirSecretSharing.run_test_cases(ff, 1)
         ShamirSecretSharing.run_test_cases(ff, 2)
         ShamirSecretSharing.run_test_cases(ff, 5)
+        ShamirSecretSharing.run_test_cases(ff, 20)
+        ShamirSecretSharing.run_test_cases(GF(65537), 20)
+        ShamirSecretSharing.run_test_cases(GF(2**128), 5)
 
     def test_benolah_secret_sharing():
         ff = FiniteField(101**41)